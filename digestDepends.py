@@ -1,10 +1,16 @@
 
 # Program to digest make depend files
+import json
 import os
 import re
+import shlex
+import struct
 import sys
-from typing import Dict, List, Set
-from collections import defaultdict
+import threading
+from array import array
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
 DirectoryName = str
 FileName = str
@@ -12,45 +18,102 @@ FileName = str
 
 
 
+# Matches "#include <x>" and "#include "x"" directives, allowing whitespace before and
+# after the '#'. Group 1 is the opening delimiter, group 2 the included item.
+INCLUDE_DIRECTIVE = re.compile(rb'^[ \t]*#[ \t]*include[ \t]*([<"])([^">\r\n]*)[">]', re.MULTILINE)
+
+# Number of source files handed to a scanning thread at a time.
+SCAN_CHUNK_SIZE = 64
+
+# Number of compile database entries queued per thread, so the database is not read
+# into pending work faster than it is processed.
+ENTRIES_IN_FLIGHT_PER_THREAD = 4
+
+
+def read_file_bytes(source: FileName) -> bytes:
+    """ Return the contents of a file, or empty bytes (after reporting) if it cannot be read. """
+    try:
+        with open(source, 'rb') as f:
+            return f.read()
+    except OSError as err:
+        print(f"Failed to open file {source}: {err}")
+        return b''
+
+
+def scan_include_directives(source: FileName) -> List[Tuple[str, str]]:
+    """ Return the (delimiter, item) pairs of the #include directives of a source file.
+
+    The delimiter is '"' or '<', so callers can tell quote includes from angle includes.
+    Directives appear in the order they occur in the file.
+    """
+    data = read_file_bytes(source)
+    # Most files can be rejected without running the regular expression at all.
+    if data.find(b'include') == -1:
+        return []
+    return [(match.group(1).decode('latin-1'), match.group(2).decode('latin-1'))
+            for match in INCLUDE_DIRECTIVE.finditer(data)]
+
+
 def extract_includes_from_file(source: FileName) -> Set[str]:
     """ Return a set of relative filenames included by a given source file. """
-    includes = set()
-    prog = re.compile('#include *[<"]([^">]*)[">]')
-    try:
-        with open(source, 'r', encoding="latin-1") as f:
-            try:
-                line_num = 0
-                for line in f:
-                    line_num = line_num + 1
-                    try:
-                        match = prog.match(line)
-                        if match:
-                            item = match.group(1)
-                            includes.add(item)
-                        pass
-                    except:
-                        print(f"Unexpected error on line {line_num}:", sys.exc_info()[0])
-                pass
-            except:
-                print("Unexpected error:", sys.exc_info()[0])
-    except:
-        print("Unexpected error:", sys.exc_info()[0])
-        print(f"Failed to open file {source}")
-    return includes
+    data = read_file_bytes(source)
+    if data.find(b'include') == -1:
+        return set()
+    return {match.group(2).decode('latin-1') for match in INCLUDE_DIRECTIVE.finditer(data)}
 
 
-def extract_includes_from_files(sources: List[FileName]) -> List[str]:
+def scan_files_in_parallel(scan, sources: List[FileName], max_workers: int = None) -> List:
+    """ Apply scan to each source using a thread pool and return the results in source order.
+
+    Reading is I/O bound and releases the GIL, so threads keep several reads in flight.
+
+    :param scan: Function taking a file name, e.g. extract_includes_from_file
+    :param sources: Files to scan
+    :param max_workers: Number of threads, or None for the ThreadPoolExecutor default
+    :return: List with scan(source) for each source
+    """
+    if len(sources) <= SCAN_CHUNK_SIZE:
+        return [scan(source) for source in sources]
+    # ThreadPoolExecutor.map takes one task per item, so hand out the chunks explicitly.
+    chunks = [sources[start:start + SCAN_CHUNK_SIZE] for start in range(0, len(sources), SCAN_CHUNK_SIZE)]
+    result = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for chunk_result in executor.map(lambda chunk: [scan(source) for source in chunk], chunks):
+            result.extend(chunk_result)
+    return result
+
+
+def extract_includes_from_files(sources: List[FileName], max_workers: int = None) -> List[str]:
     """ Union and sort all include files as specified in the #include directives. """
     all_includes = set()
-    for source in sources:
-        includes = extract_includes_from_file(source)
-        if len(includes) > 0:
-            all_includes = all_includes.union(includes)
-    result = [include for include in all_includes]
-    result.sort()
+    for includes in scan_files_in_parallel(extract_includes_from_file, sources, max_workers):
+        all_includes.update(includes)
+    result = sorted(all_includes)
     return result
 
 
+def extract_includes_by_file(sources: List[FileName], max_workers: int = None) -> Dict[FileName, Set[str]]:
+    """ Return a dictionary mapping each source file to the set of items it includes.
+
+    Each file is read once, so the result can be shared by every later query.
+    """
+    includes_list = scan_files_in_parallel(extract_includes_from_file, sources, max_workers)
+    return dict(zip(sources, includes_list))
+
+
+def union_includes(include_map: Dict[FileName, Set[str]], sources: List[FileName]) -> List[str]:
+    """ Union and sort the cached includes of the given sources.
+
+    :param include_map: Result of extract_includes_by_file
+    :param sources: Files whose includes are wanted; each must be a key of include_map
+    :return: Sorted list of include items
+    """
+    all_includes = set()
+    for source in sources:
+        all_includes.update(include_map[source])
+    return sorted(all_includes)
+
+
 def get_how_included(includes: List[FileName]):
     """ Return a dictionary showing how each simple include file is referenced.
 
@@ -73,33 +136,82 @@ def get_how_included(includes: List[FileName]):
 
 
 def get_unused_files(all_source_files: List[FileName], used_files: List[FileName]) -> List[FileName]:
-    """ Subtract used files from all files to give unused files. """
-    used_set = {used for used in used_files}
-    result = [f for f in all_source_files if not (f in used_set)]
+    """ Subtract used files from all files to give unused files.
+
+    Both lists must be sorted. They are compared in a single merge pass.
+    """
+    result = []
+    used_index = 0
+    num_used = len(used_files)
+    for file in all_source_files:
+        while used_index < num_used and used_files[used_index] < file:
+            used_index += 1
+        if used_index < num_used and used_files[used_index] == file:
+            continue
+        result.append(file)
     return result
 
 
+def get_file_size(file: FileName) -> int:
+    """ Return the size of a file in bytes, or 0 if it cannot be found. """
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return 0
+
+
+def summarize_by_directory(files: List[FileName], root_directory: DirectoryName) -> List[str]:
+    """ Return report lines giving the number and total size of the files in each directory.
+
+    Each line is "directory<TAB>files<TAB>bytes<TAB>subtree files<TAB>subtree bytes", where
+    the subtree columns also count everything below the directory. Lines are sorted by
+    directory; the root-relative top directory is shown as ".".
+
+    :param files: Root-relative file names
+    :param root_directory: Directory the file names are relative to
+    :return: List of report lines
+    """
+    sizes = scan_files_in_parallel(get_file_size, [os.path.join(root_directory, file) for file in files])
+    direct = {}
+    subtree = {}
+    for file, size in zip(files, sizes):
+        directory = os.path.dirname(file)
+        count, total = direct.get(directory, (0, 0))
+        direct[directory] = (count + 1, total + size)
+        while True:
+            count, total = subtree.get(directory, (0, 0))
+            subtree[directory] = (count + 1, total + size)
+            if directory == '':
+                break
+            directory = os.path.dirname(directory)
+    lines = []
+    for directory in sorted(subtree):
+        count, total = direct.get(directory, (0, 0))
+        subtree_count, subtree_total = subtree[directory]
+        lines.append(f"{directory or '.'}\t{count}\t{total}\t{subtree_count}\t{subtree_total}")
+    return lines
+
+
 def get_unique_directories(filelist: List[FileName],
                            how_included: Dict[FileName, Set[FileName]]) -> List[DirectoryName]:
-    """ Return list of unique directories that contain the given files. """
-    dirs = []
+    """ Return list of unique directories that contain the given files.
+
+    A file that is included as "x/y/z.h" contributes the directory above "x", since
+    that is the directory that must be on the include path.
+    """
+    include_paths = {path for paths in how_included.values() for path in paths}
+    index = PathSuffixIndex(filelist, get_max_components(include_paths))
+    dirs = set()
+    for path in include_paths:
+        for file in index.paths_with_suffix(path):
+            # The file must be strictly below the directory, as in "dir/x/y/z.h".
+            if len(file) > len(path):
+                dirs.add(file[0: len(file) - len(path) - 1])
     for file in filelist:
-        simple = os.path.basename(file)
-        if simple in how_included:
-            paths = how_included[simple]
-            if len(paths) > 1:
-                pass
-                # print("multiple paths")
-            for path in paths:
-                if file.endswith('/' + path):
-                    ref_dir = file[0: len(file) - len(path) - 1]
-                    dirs.append(ref_dir)
-            pass
-        else:
-            dirs.append(os.path.dirname(file))
-            pass
+        if os.path.basename(file) not in how_included:
+            dirs.add(os.path.dirname(file))
 
-    unique_dirs = get_unique_list(dirs)
+    unique_dirs = get_unique_list(list(dirs))
     return unique_dirs
 
 
@@ -121,22 +233,86 @@ def get_unique_list(items):
 
 
 
-def digest_line(line, source_directory):
-    """ Return a list of normalized dependencies mentioned on the given line.
+# A word of make dependency syntax, or a ':' rule separator. Backslash escapes stay in the word.
+DEPEND_WORD_OR_COLON = re.compile(r'(?:\\.|[^\s\\:])+|:')
+# A word of make dependency syntax in a prerequisite list, where ':' is an ordinary character.
+DEPEND_WORD = re.compile(r'(?:\\.|[^\s\\])+')
+# Escapes used by compilers when writing dependency files.
+DEPEND_ESCAPE = re.compile(r'\\([ #:\\])|\$\$')
+
+
+def unescape_depend_word(word: str) -> str:
+    """ Undo make escaping in a word: "\\ " is a space, "\\#" a '#' and "$$" a '$'. """
+    if '\\' not in word and '$' not in word:
+        return word
+    return DEPEND_ESCAPE.sub(lambda match: match.group(1) or '$', word)
+
+
+def iter_logical_depend_lines(lines: Iterable[str]) -> Iterator[str]:
+    """ Join continuation lines (ending in an unescaped backslash) and yield each logical line. """
+    pending = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        stripped = line.rstrip('\\')
+        if (len(line) - len(stripped)) % 2 == 1:
+            # Odd number of trailing backslashes: the last one continues the line.
+            pending.append(line[:-1])
+            pending.append(' ')
+            continue
+        if pending:
+            pending.append(line)
+            line = ''.join(pending)
+            pending = []
+        yield line
+    if pending:
+        yield ''.join(pending)
+
 
-    :param line: The line to digest
-    :param source_directory: directory to which relative files are relative
-    :return: List of normalized dependency file names.
+def iter_depend_rules(lines: Iterable[str]) -> Iterator[Tuple[List[str], List[str]]]:
+    """ Parse make dependency syntax incrementally, yielding (targets, prerequisites) per rule.
+
+    Handles continuation lines, backslash-escaped spaces and '#', "$$", comments,
+    several rules per file and the prerequisite-less phony rules written by -MP.
+    Order-only prerequisites (after '|') are treated as ordinary prerequisites.
+
+    :param lines: Lines of a .d file, e.g. an open file
     """
-    items = line.split()
-    normedItems = []
-    for item in items:
-        if item[0] == ".":
-            pass
-            # print(f"Relative item = {item}")
-        normed = DigestDepends.normalize_file(item, source_directory)
-        normedItems.append(normed)
-    return normedItems
+    for line in iter_logical_depend_lines(lines):
+        if '\\' not in line:
+            # Nothing is escaped, so plain string splitting gives the same words much faster.
+            comment = line.find('#')
+            if comment != -1:
+                line = line[:comment]
+            colon = line.find(':')
+            if colon == -1:
+                continue
+            targets = line[:colon].split()
+            prerequisites = line[colon + 1:].split()
+            if '|' in prerequisites or ':' in prerequisites:
+                prerequisites = [word for word in prerequisites if word not in (':', '|')]
+            if '$' in line:
+                targets = [unescape_depend_word(word) for word in targets]
+                prerequisites = [unescape_depend_word(word) for word in prerequisites]
+            if len(targets) > 0:
+                yield targets, prerequisites
+            continue
+        targets = []
+        prerequisites = None
+        for match in DEPEND_WORD_OR_COLON.finditer(line):
+            word = match.group(0)
+            if word.startswith('#'):
+                break
+            if word == ':':
+                prerequisites = []
+                for prerequisite in DEPEND_WORD.findall(line, match.end()):
+                    if prerequisite.startswith('#'):
+                        break
+                    if prerequisite not in (':', '|'):
+                        prerequisites.append(unescape_depend_word(prerequisite))
+                break
+            targets.append(unescape_depend_word(word))
+        if prerequisites is not None and len(targets) > 0:
+            yield targets, prerequisites
 
 
 def get_source_extensions(filelist: List[FileName]) -> Set[str]:
@@ -154,81 +330,709 @@ def get_source_extensions(filelist: List[FileName]) -> Set[str]:
     return extensions
 
 
-def filter_includes(all_includes: List[FileName], referenced_files: List[FileName]):
+def get_max_components(paths) -> int:
+    """ Return the largest number of '/' separated components in any of the paths. """
+    max_components = 0
+    for path in paths:
+        num_components = path.count('/') + 1
+        if num_components > max_components:
+            max_components = num_components
+    return max_components
+
+
+class PathSuffixNode:
+    """ Node of a PathSuffixIndex. """
+    __slots__ = ('children', 'count', 'path_ids')
+
+    def __init__(self):
+        self.children: Dict[str, 'PathSuffixNode'] = {}
+        # Number of indexed paths that end with the suffix this node represents.
+        self.count = 0
+        # Indices of the paths whose (possibly truncated) suffix ends at this node.
+        self.path_ids = None
+
+
+class PathSuffixIndex:
+    """ Index of file paths by their trailing path components.
+
+    The paths are stored in a trie keyed on their components in reverse order,
+    so "x/y/z.h" is found by following "z.h", "y", "x". Components are interned
+    and shared between paths, so memory grows with the number of unique components
+    rather than with the number of suffix strings. Only the first max_components
+    components (from the end) of each path are indexed.
+    """
+
+    def __init__(self, paths: List[FileName], max_components: int = None):
+        self.paths = list(paths)
+        self.root = PathSuffixNode()
+        for path_id, path in enumerate(self.paths):
+            components = path.split('/')
+            depth = len(components)
+            if max_components is not None:
+                depth = min(depth, max_components)
+            node = self.root
+            for i in range(1, depth + 1):
+                component = sys.intern(components[-i])
+                child = node.children.get(component)
+                if child is None:
+                    child = PathSuffixNode()
+                    node.children[component] = child
+                child.count += 1
+                node = child
+            if node.path_ids is None:
+                node.path_ids = []
+            node.path_ids.append(path_id)
+
+    def find(self, suffix: str):
+        """ Return the node for the given relative suffix, or None if no path ends with it. """
+        node = self.root
+        for component in reversed(suffix.split('/')):
+            node = node.children.get(component)
+            if node is None:
+                return None
+        return node
+
+    def count(self, suffix: str) -> int:
+        """ Return how many paths, and hence how many distinct prefixes, end with suffix. """
+        node = self.find(suffix)
+        return node.count if node is not None else 0
+
+    def paths_with_suffix(self, suffix: str) -> List[FileName]:
+        """ Return the indexed paths that end with the given suffix. """
+        node = self.find(suffix)
+        if node is None:
+            return []
+        result = []
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if node.path_ids is not None:
+                result.extend(self.paths[path_id] for path_id in node.path_ids)
+            stack.extend(node.children.values())
+        return result
+
+
+def filter_includes(all_includes: List[FileName], referenced_files: List[FileName],
+                    index: PathSuffixIndex = None):
     """ Filter a  list of include items by removing those that do not appear in referenced files.
 
     :param all_includes: Include items to filter
     :param referenced_files: List of all files referenced by the build
+    :param index: Optional index of referenced_files, indexed deeply enough for all_includes.
+    It is built here if not given.
     :return: The sublist of all_includes that are used.
     """
-    max_components = 0
-    for include in all_includes:
-        components = include.split('/')
-        num_components = len(components)
-        if num_components > max_components:
-            max_components = num_components
-
-    # Make dictionary for faster checking
-    filter_dict = defaultdict(set)
-    for filename in referenced_files:
-        components = filename.split('/')
-        num_components = min(len(components), max_components)
-        prefix = filename
-        suffix = ""
-        for i in range(0, num_components):
-            base = os.path.basename(prefix)
-            prefix = os.path.dirname(prefix)
-            if suffix != '':
-                suffix = os.path.join(base, suffix)
-            else:
-                suffix = base
-            filter_dict[suffix].add(prefix)
+    if index is None:
+        index = PathSuffixIndex(referenced_files, get_max_components(all_includes))
     ambiguous_includes = set()
     result = []
     for include in all_includes:
-        if include in filter_dict:
+        num_prefixes = index.count(include)
+        if num_prefixes > 0:
             result.append(include)
-            prefixes = filter_dict[include]
-            if len(prefixes) > 1:
+            if num_prefixes > 1:
                 ambiguous_includes.add(include)
         else:
-            print("include "
-                  ""
-                  ""
-                  ""
-                  ""
-                  "cd"
-                  ""
-                  ""
-                  ""
-                  ""
-                  ""
+            print("include not found in referenced files: " + include)
+    return result
 
 
+class DirectoryListingCache:
+    """ Lists each directory at most once and remembers which entries are files and directories.
 
+    Entries are classified following symbolic links, as os.path.isfile and os.path.isdir do.
+    The cache can be shared between threads.
+    """
 
+    def __init__(self):
+        self.listings: Dict[DirectoryName, Tuple[Set[str], Set[str]]] = {}
+        self.lock = threading.Lock()
+
+    def list_dir(self, directory: DirectoryName) -> Tuple[Set[str], Set[str]]:
+        """ Return the sets of file names and subdirectory names in directory. """
+        with self.lock:
+            listing = self.listings.get(directory)
+        if listing is None:
+            files = set()
+            dirs = set()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        try:
+                            if entry.is_dir():
+                                dirs.add(entry.name)
+                            elif entry.is_file():
+                                files.add(entry.name)
+                        except OSError:
+                            pass
+            except OSError:
+                pass
+            with self.lock:
+                # Another thread may have listed it meanwhile; keep the first listing.
+                listing = self.listings.setdefault(directory, (files, dirs))
+        return listing
+
+    def is_file(self, directory: DirectoryName, relative: FileName) -> bool:
+        """ Return True if directory/relative is a file, answered from the cached listings. """
+        if not is_plain_relative(relative):
+            return os.path.isfile(os.path.join(directory, relative))
+        components = relative.split('/')
+        for component in components[:-1]:
+            if component not in self.list_dir(directory)[1]:
+                return False
+            directory = os.path.join(directory, component)
+        return components[-1] in self.list_dir(directory)[0]
+
+
+def is_plain_relative(include: FileName) -> bool:
+    """ Return True if include is a relative path with no empty, '.' or '..' components. """
+    if include.startswith('/'):
+        return False
+    components = include.split('/')
+    return '' not in components and '.' not in components and '..' not in components
+
+
+def map_includes_to_directories(includes: List[FileName],
+                                include_directories: List[DirectoryName],
+                                cache: DirectoryListingCache = None) -> Dict[FileName, List[DirectoryName]]:
+    """ Return a dictionary from each include item to the include directories that contain it.
+
+    Each include directory is listed once. The include items are arranged in a trie of
+    their components, so only subdirectories that begin some include item are listed.
+
+    :param includes: Items in #include directives
+    :param include_directories: Directories to search, in search order
+    :param cache: Listing cache to use, so listings can be shared with other queries
+    :return: Dictionary whose values list the directories in include_directories order.
+    Items found in no directory are absent.
+    """
+    if cache is None:
+        cache = DirectoryListingCache()
+    # Trie of include components. The None key of a node holds the include ending there.
+    trie = {}
+    irregular = []
+    for include in includes:
+        if not is_plain_relative(include):
+            irregular.append(include)
+            continue
+        node = trie
+        for component in include.split('/'):
+            node = node.setdefault(component, {})
+        node[None] = include
+
+    result: Dict[FileName, List[DirectoryName]] = {}
+    for inc_dir in include_directories:
+        stack = [(trie, inc_dir)]
+        while stack:
+            node, directory = stack.pop()
+            files, dirs = cache.list_dir(directory)
+            for component, child in node.items():
+                if component is None:
+                    continue
+                include = child.get(None)
+                if include is not None and component in files:
+                    result.setdefault(include, []).append(inc_dir)
+                if component in dirs and len(child) > (include is not None):
+                    stack.append((child, os.path.join(directory, component)))
+        for include in irregular:
+            if os.path.isfile(os.path.join(inc_dir, include)):
+                result.setdefault(include, []).append(inc_dir)
+    return result
 
 
-type p                  ""
-                  ""
-                  ""
-                  ": " + include)
-    return result
+def read_polyspace_include_order(options_filename: FileName) -> Dict[FileName, List[DirectoryName]]:
+    """ Return the -I directories, in command line order, of each source in a Polyspace options file.
+
+    :param options_filename: Polyspace options file with one -options-for-sources line per source
+    :return: Dictionary from source file to its ordered list of include directories.
+    """
+    include_order = {}
+    with open(options_filename, 'r', encoding="latin-1") as f:
+        for line in f:
+            line = line.strip("\\\n")
+            if not line.startswith("-options-for-sources "):
+                continue
+            parts = line[len("-options-for-sources "):].split(";")
+            include_order[parts[0]] = [part[3:] for part in parts[1:] if part.startswith("-I ")]
+    return include_order
+
+
+def iter_json_array(filename: FileName, chunk_size: int = 1 << 20) -> Iterator:
+    """ Yield the elements of a JSON array file one at a time, without loading the whole file.
+
+    :param filename: File containing a single JSON array, e.g. compile_commands.json
+    :param chunk_size: Number of characters read at a time
+    """
+    decoder = json.JSONDecoder()
+    with open(filename, 'r', encoding='utf-8') as f:
+        buffer = f.read(chunk_size).lstrip()
+        if not buffer.startswith('['):
+            raise ValueError(f"{filename} does not contain a JSON array")
+        position = 1
+        at_eof = False
+        while True:
+            # Skip whitespace and the separating comma.
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                    position += 1
+                if position < len(buffer) or at_eof:
+                    break
+                buffer = f.read(chunk_size)
+                position = 0
+                at_eof = buffer == ''
+            if position >= len(buffer):
+                raise ValueError(f"{filename}: unterminated JSON array")
+            if buffer[position] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if at_eof:
+                    raise
+                # The element is cut off at the end of the buffer; read more and retry.
+                more = f.read(chunk_size)
+                at_eof = more == ''
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+            yield element
+            position = end
+
+
+def get_compile_entry_includes(entry: Dict) -> Tuple[FileName, List[DirectoryName], List[DirectoryName],
+                                                      List[DirectoryName]]:
+    """ Return the absolute source file and ordered include directories of a compile database entry.
+
+    Returns (source, quote directories, include directories, after directories): the
+    -iquote directories, which the compiler only searches for quote includes, the -I
+    and -isystem directories in the order the compiler searches them, and the
+    -idirafter directories, which it only searches after the system directories.
+    """
+    directory = entry.get('directory', '')
+    if 'arguments' in entry:
+        arguments = entry['arguments']
+    else:
+        arguments = shlex.split(entry.get('command', ''))
+    option_order = ['-iquote', '-I', '-isystem', '-idirafter']
+    include_directories = {option: [] for option in option_order}
+    i = 0
+    while i < len(arguments):
+        argument = arguments[i]
+        i += 1
+        for option in option_order:
+            if argument.startswith(option):
+                value = argument[len(option):]
+                if value == '' and i < len(arguments):
+                    value = arguments[i]
+                    i += 1
+                if value != '':
+                    include_directories[option].append(os.path.normpath(os.path.join(directory, value)))
+                break
+    source = os.path.normpath(os.path.join(directory, entry['file']))
+    return (source, include_directories['-iquote'],
+            include_directories['-I'] + include_directories['-isystem'], include_directories['-idirafter'])
+
+
+class SearchPathNode:
+    """ One directory of an include search path.
+
+    Search paths are stored as a trie, so translation units whose -I lists share a
+    prefix share the nodes, and the lookups cached in them, for that prefix. A
+    quote_only node is an -iquote directory, which angle includes skip.
+    """
+    __slots__ = ('directory', 'quote_only', 'parent', 'children', 'matches', 'file_results')
+
+    def __init__(self, directory: DirectoryName, quote_only: bool, parent: 'SearchPathNode'):
+        self.directory = directory
+        self.quote_only = quote_only
+        self.parent = parent
+        self.children: Dict[Tuple[DirectoryName, bool], 'SearchPathNode'] = {}
+        # Include item -> nodes of the path up to here whose directory contains it, in search order.
+        self.matches: Dict[FileName, Tuple['SearchPathNode', ...]] = {}
+        # File -> resolution of its directives with the full search path ending here.
+        self.file_results: Dict[FileName, List[Tuple[str, FileName, List[FileName]]]] = {}
+
+
+class IncludeSearchSimulator:
+    """ Resolve #include directives the way the compiler does for a given -I order.
+
+    Quote includes are looked up first in the directory of the including file, then
+    in the -iquote directories and then along the rest of the search path; angle
+    includes only along the rest of the search path. This is the gcc/clang rule.
+    The first match is the header the compiler uses and any later matches are
+    shadowed by it. Preprocessor conditionals are not evaluated, so every directive
+    in a reached file is followed.
+
+    One simulator can be shared between threads; its caches are guarded by a lock,
+    which is not held while files are scanned or directories listed.
+    """
+
+    def __init__(self, system_directories: List[DirectoryName] = None,
+                 cache: DirectoryListingCache = None):
+        """ Initialize an IncludeSearchSimulator.
+
+        :param system_directories: Directories searched after every translation unit's -I list
+        :param cache: Listing cache to use, so listings can be shared with other queries
+        """
+        self.system_directories = list(system_directories or [])
+        self.cache = cache if cache is not None else DirectoryListingCache()
+        self.root = SearchPathNode('', False, None)
+        self.directives: Dict[FileName, List[Tuple[str, str]]] = {}
+        self.lock = threading.Lock()
+
+    def search_path(self, include_directories: List[DirectoryName],
+                    after_directories: List[DirectoryName] = (),
+                    quote_directories: List[DirectoryName] = ()) -> SearchPathNode:
+        """ Return the (shared) node that ends the search path for the given -I list.
+
+        quote_directories (-iquote) are searched before it, for quote includes only.
+        after_directories (e.g. -idirafter) are searched after the system directories.
+        """
+        path = ([(directory, True) for directory in quote_directories] +
+                [(directory, False) for directory in
+                 list(include_directories) + self.system_directories + list(after_directories)])
+        node = self.root
+        with self.lock:
+            for key in path:
+                child = node.children.get(key)
+                if child is None:
+                    child = SearchPathNode(key[0], key[1], node)
+                    node.children[key] = child
+                node = child
+        return node
+
+    def find_in_search_path(self, node: SearchPathNode, include: FileName) -> Tuple[SearchPathNode, ...]:
+        """ Return the nodes of the search path ending at node whose directory contains include. """
+        pending = []
+        with self.lock:
+            while node is not self.root and include not in node.matches:
+                pending.append(node)
+                node = node.parent
+            found = node.matches[include] if node is not self.root else ()
+        for node in reversed(pending):
+            if self.cache.is_file(node.directory, include):
+                found = found + (node,)
+            with self.lock:
+                found = node.matches.setdefault(include, found)
+        return found
+
+    def resolve(self, includer: FileName, delimiter: str, include: FileName,
+                node: SearchPathNode) -> Tuple[FileName, List[FileName]]:
+        """ Return the header a directive resolves to (or None) and the headers it shadows. """
+        if include.startswith('/'):
+            return (include if os.path.isfile(include) else None), []
+        candidates = []
+        if delimiter == '"':
+            includer_dir = os.path.dirname(includer)
+            if self.cache.is_file(includer_dir, include):
+                candidates.append(os.path.normpath(os.path.join(includer_dir, include)))
+        for match in self.find_in_search_path(node, include):
+            if match.quote_only and delimiter != '"':
+                continue
+            candidate = os.path.normpath(os.path.join(match.directory, include))
+            if candidate not in candidates:
+                candidates.append(candidate)
+        if len(candidates) == 0:
+            return None, []
+        return candidates[0], candidates[1:]
+
+    def get_directives(self, file: FileName) -> List[Tuple[str, str]]:
+        """ Return the cached #include directives of a file. """
+        with self.lock:
+            directives = self.directives.get(file)
+        if directives is None:
+            directives = scan_include_directives(file)
+            with self.lock:
+                directives = self.directives.setdefault(file, directives)
+        return directives
+
+    def resolve_file(self, node: SearchPathNode, file: FileName) -> List[Tuple[str, FileName, List[FileName]]]:
+        """ Return (include, header, shadowed) for each directive of file under the given search path. """
+        with self.lock:
+            results = node.file_results.get(file)
+        if results is None:
+            results = [(include,) + self.resolve(file, delimiter, include, node)
+                       for delimiter, include in self.get_directives(file)]
+            with self.lock:
+                results = node.file_results.setdefault(file, results)
+        return results
+
+    def simulate(self, source: FileName, include_directories: List[DirectoryName],
+                 after_directories: List[DirectoryName] = (),
+                 quote_directories: List[DirectoryName] = ()) -> List[Tuple[FileName, str, FileName, List[FileName]]]:
+        """ Follow the includes of a translation unit and return how each directive resolves.
+
+        :param source: The translation unit
+        :param include_directories: Its -I directories in command line order
+        :param after_directories: Its -idirafter directories, searched after the system directories
+        :param quote_directories: Its -iquote directories, searched first for quote includes only
+        :return: List of (includer, include, header, shadowed) for each directive reached,
+        where header is None if the directive does not resolve.
+        """
+        node = self.search_path(include_directories, after_directories, quote_directories)
+        records = []
+        visited = {source}
+        stack = [source]
+        while stack:
+            file = stack.pop()
+            for include, header, shadowed in self.resolve_file(node, file):
+                records.append((file, include, header, shadowed))
+                if header is not None and header not in visited:
+                    visited.add(header)
+                    stack.append(header)
+        return records
+
+
+class IncludeGraph:
+    """ Compact dependency graph over files, stored as compressed sparse row (CSR) arrays.
+
+    Node i is the file names[i]. Its successors (the files it depends on) are
+    targets[offsets[i]:offsets[i + 1]]. Nodes flagged in is_tu are translation units.
+    The graph can be saved to a binary file and loaded back without re-parsing.
+    """
+
+    MAGIC = b'INCGRPH1'
+    HEADER = struct.Struct('<8sQQQ')
+
+    def __init__(self, names: List[FileName], offsets: array, targets: array, is_tu: bytearray):
+        self.names = names
+        self.offsets = offsets
+        self.targets = targets
+        self.is_tu = is_tu
+        self.ids: Dict[FileName, int] = {name: i for i, name in enumerate(names)}
+        self.reverse_graph = None
+
+    @staticmethod
+    def from_edges(edges: Iterable[Tuple[FileName, FileName]],
+                   translation_units: Iterable[FileName] = ()) -> 'IncludeGraph':
+        """ Build a graph from (file, dependency) pairs. Duplicate edges and self loops are dropped. """
+        ids: Dict[FileName, int] = {}
+        names: List[FileName] = []
+
+        def get_id(name: FileName) -> int:
+            node_id = ids.get(name)
+            if node_id is None:
+                node_id = len(names)
+                ids[name] = node_id
+                names.append(name)
+            return node_id
+
+        tu_ids = [get_id(tu) for tu in translation_units]
+        edge_set = {(get_id(source), get_id(target)) for source, target in edges}
+        is_tu = bytearray(len(names))
+        for tu_id in tu_ids:
+            is_tu[tu_id] = 1
+        return IncludeGraph.from_id_edges(names, edge_set, is_tu)
+
+    @staticmethod
+    def from_id_edges(names: List[FileName], edge_set: Set[Tuple[int, int]], is_tu: bytearray) -> 'IncludeGraph':
+        """ Build the CSR arrays from a set of (source id, target id) pairs. """
+        counts = [0] * (len(names) + 1)
+        targets = array('i')
+        for source, target in sorted(edge_set):
+            if source != target:
+                counts[source + 1] += 1
+                targets.append(target)
+        offsets = array('i', counts)
+        for i in range(1, len(offsets)):
+            offsets[i] += offsets[i - 1]
+        return IncludeGraph(names, offsets, targets, is_tu)
+
+    def reverse(self) -> 'IncludeGraph':
+        """ Return the (cached) graph with every edge reversed, used for dependents queries. """
+        if self.reverse_graph is None:
+            # Counting sort of the edges by target; the edges are already unique.
+            num_nodes = len(self.names)
+            offsets = self.offsets
+            targets = self.targets
+            counts = [0] * (num_nodes + 1)
+            for target in targets:
+                counts[target + 1] += 1
+            reverse_offsets = array('i', counts)
+            for i in range(1, num_nodes + 1):
+                reverse_offsets[i] += reverse_offsets[i - 1]
+            position = list(reverse_offsets[:num_nodes])
+            reverse_targets = array('i', bytes(targets.itemsize * len(targets)))
+            for source in range(num_nodes):
+                for k in range(offsets[source], offsets[source + 1]):
+                    target = targets[k]
+                    reverse_targets[position[target]] = source
+                    position[target] += 1
+            self.reverse_graph = IncludeGraph(self.names, reverse_offsets, reverse_targets, self.is_tu)
+            self.reverse_graph.ids = self.ids
+            self.reverse_graph.reverse_graph = self
+        return self.reverse_graph
+
+    def reachable_ids(self, start_ids: List[int]) -> List[int]:
+        """ Return the ids of the nodes reachable from start_ids (not counting the start nodes themselves). """
+        offsets = self.offsets
+        targets = self.targets
+        visited = bytearray(len(self.names))
+        for node_id in start_ids:
+            visited[node_id] = 1
+        stack = list(start_ids)
+        result = []
+        while stack:
+            node_id = stack.pop()
+            for k in range(offsets[node_id], offsets[node_id + 1]):
+                target = targets[k]
+                if not visited[target]:
+                    visited[target] = 1
+                    result.append(target)
+                    stack.append(target)
+        return result
 
+    def get_ids(self, names: List[FileName]) -> List[int]:
+        """ Return the node ids of the given files, reporting any that are not in the graph. """
+        result = []
+        for name in names:
+            if name in self.ids:
+                result.append(self.ids[name])
+            else:
+                print(f"Not in graph: {name}")
+        return result
+
+    def closure(self, names: List[FileName]) -> List[FileName]:
+        """ Return the sorted transitive dependencies of the given files. """
+        return sorted(self.names[i] for i in self.reachable_ids(self.get_ids(names)))
+
+    def dependents(self, names: List[FileName]) -> List[FileName]:
+        """ Return the sorted files that transitively depend on any of the given files. """
+        return sorted(self.names[i] for i in self.reverse().reachable_ids(self.get_ids(names)))
+
+    def dependent_translation_units(self, names: List[FileName]) -> List[FileName]:
+        """ Return the sorted translation units that pull in any of the given files. """
+        return sorted(self.names[i] for i in self.reverse().reachable_ids(self.get_ids(names))
+                      if self.is_tu[i])
+
+    def save(self, filename: FileName) -> None:
+        """ Write the graph to a binary file that load can read back. """
+        offsets = array('i', self.offsets)
+        targets = array('i', self.targets)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            targets.byteswap()
+        names_bytes = '\n'.join(self.names).encode('utf-8', 'surrogateescape')
+        with open(filename, 'wb') as w:
+            w.write(self.HEADER.pack(self.MAGIC, len(self.names), len(targets), len(names_bytes)))
+            w.write(offsets.tobytes())
+            w.write(targets.tobytes())
+            w.write(bytes(self.is_tu))
+            w.write(names_bytes)
+
+    @staticmethod
+    def load(filename: FileName) -> 'IncludeGraph':
+        """ Read a graph written by save. """
+        with open(filename, 'rb') as f:
+            data = f.read()
+        magic, num_nodes, num_edges, names_length = IncludeGraph.HEADER.unpack_from(data, 0)
+        if magic != IncludeGraph.MAGIC:
+            raise ValueError(f"{filename} is not an include graph file")
+        position = IncludeGraph.HEADER.size
+        offsets = array('i')
+        offsets.frombytes(data[position:position + (num_nodes + 1) * offsets.itemsize])
+        position += (num_nodes + 1) * offsets.itemsize
+        targets = array('i')
+        targets.frombytes(data[position:position + num_edges * targets.itemsize])
+        position += num_edges * targets.itemsize
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+            targets.byteswap()
+        is_tu = bytearray(data[position:position + num_nodes])
+        position += num_nodes
+        names_bytes = data[position:position + names_length]
+        names = names_bytes.decode('utf-8', 'surrogateescape').split('\n') if num_nodes > 0 else []
+        return IncludeGraph(names, offsets, targets, is_tu)
 
 
 class DigestDepends:
     """ Digest .depend files"""
 
-    def __init__(self, project_root_directory: DirectoryName, tag: str):
+    def __init__(self, project_root_directory: DirectoryName, tag: str,
+                 source_directory_names: List[DirectoryName] = None):
         """ Initialize a DigestDepends object.
 
         :param tag: String marking this configuration analyzed
         :param project_root_directory:
+        :param source_directory_names: Candidate names of the directory a source was compiled
+        in, relative to the parent of the object directory, for .d files whose object
+        is "../dir/file.o". The first one containing the source is used.
         """
         self.tag = tag
         self.project_root_directory = project_root_directory
-
+        if source_directory_names is None:
+            source_directory_names = ["src", "src_opt"]
+        self.source_directory_names = source_directory_names
+
+    def find_source_directory(self, depend_dir: DirectoryName, objfile: FileName,
+                              source_file: FileName) -> DirectoryName:
+        """ Return the directory a .d file's source was compiled in.
+
+        Relative paths in a .d file are relative to that directory. The .d file is
+        stored next to the object file, so the compile directory is recovered from
+        the object file's path as written in the rule.
+
+        :param depend_dir: Directory holding the .d file
+        :param objfile: The rule's target, i.e. the object file
+        :param source_file: The rule's first prerequisite, i.e. the source file
+        :return: The compile directory
+        """
+        relative_obj_dir = os.path.dirname(objfile)
+        if relative_obj_dir == '' or os.path.isabs(relative_obj_dir):
+            # Object and source in same directory, so .d is in same directory also.
+            # An absolute object path says nothing about the compile directory, but then
+            # the build normally names its sources with absolute paths too.
+            return depend_dir
+        if relative_obj_dir == '..' or relative_obj_dir.startswith('../'):
+            suffix = relative_obj_dir[3:]
+            if suffix == '':
+                prefix = depend_dir + '/'
+            elif depend_dir.endswith('/' + suffix):
+                prefix = depend_dir[:-len(suffix)]
+            else:
+                prefix = None
+            if prefix is not None:
+                candidates = [prefix + name for name in self.source_directory_names]
+                for candidate in candidates:
+                    if os.path.exists(os.path.join(candidate, source_file)):
+                        return candidate
+                if len(candidates) > 0:
+                    return candidates[0]
+        if not relative_obj_dir.startswith('..'):
+            # Object written below the compile directory, e.g. "obj/file.o".
+            if depend_dir.endswith('/' + relative_obj_dir):
+                return depend_dir[:-len(relative_obj_dir) - 1]
+        print(f"Cannot map object directory {relative_obj_dir} of {depend_dir}; using the .d directory")
+        return depend_dir
+
+    def digest_depend_rules(self, filename: FileName) -> List[List[FileName]]:
+        """ Return, for each rule of a .d file, its normalized source followed by its dependencies.
+
+        Prerequisite-less rules for files that an earlier rule depends on are the phony
+        targets written by -MP, and are skipped.
+
+        :param filename: Name of the .d file.
+        :return: List with one [source, dependency...] list per rule.
+        """
+        depend_dir = os.path.dirname(filename)
+        result = []
+        seen_prerequisites = set()
+        with open(filename, 'r', encoding="latin-1") as f:
+            for targets, prerequisites in iter_depend_rules(f):
+                if len(prerequisites) == 0:
+                    if not all(target in seen_prerequisites for target in targets):
+                        print(f"Rule without prerequisites in {filename}: {' '.join(targets)}")
+                    continue
+                seen_prerequisites.update(prerequisites)
+                source_file = prerequisites[0]
+                source_dir = self.find_source_directory(depend_dir, targets[0], source_file)
+                absolute_source_file = os.path.join(source_dir, source_file)
+                if not os.path.exists(absolute_source_file):
+                    print(f"File does not exists: {absolute_source_file}")
+                rule_files = [absolute_source_file]
+                rule_files += [DigestDepends.normalize_file(item, source_dir) for item in prerequisites[1:]]
+                result.append(rule_files)
+        return result
 
     def digest_depend_file(self, filename: FileName) -> List[FileName]:
         """ Return list or normalized files referenced in a .depend file.
@@ -236,66 +1040,9 @@ class DigestDepends:
         :param filename: Name of the .depend file.
         :return: List of normalized dependencies.
         """
-        depend_dir = os.path.dirname(filename)
         referenced_files = []
-        with open(filename, 'r', encoding="latin-1") as f:
-            num = 0
-            objfile = ""
-            source_dir = ""
-            for line in f:
-                line = line.strip("\\\n")
-                if objfile == "":
-                    # Extract object file.
-                    colon = line.find(":")
-                    objfile = line[:colon].strip()
-                    relative_obj_dir = os.path.dirname(objfile)
-                    line = line[colon + 1:].strip()
-                if source_dir == "":
-                    # Need to extract source and source directory.
-                    items = line.split()
-                    if len(items) > 0:
-                        if len(items) > 1:
-                            pass
-                            # print(f"multiple items on first line")
-                        source_file = items[0]
-                        items = items[1:]
-                        line = " ".join(items)
-                        source_dir0 = os.path.dirname(source_file)
-                        if source_dir0 != "":
-                            print(f"For source file {source_file}, source_dir not empty = {source_dir}")
-                        # assert(source_dir == "")
-                        # Find the real source directory. Relative paths in the
-                        # depend file are relative to the source file location.
-                        # The .d file is stored in the directory with the .o file.
-                        if len(relative_obj_dir) == 0:
-                            # Object and source in same directory, so .d is in same
-                            # directory also.
-                            source_dir = depend_dir
-                            absolute_source_file = os.path.join(source_dir, source_file)
-                        else:
-                            assert (relative_obj_dir[0:3] == "../")
-                            suffix = relative_obj_dir[3:]
-                            assert (depend_dir.endswith(suffix))
-                            prefix = depend_dir[:-len(suffix)]
-                            source_dir = prefix + "src"
-                            absolute_source_file = os.path.join(source_dir, source_file)
-                            if not os.path.exists(absolute_source_file):
-                                source_dir = prefix + "src_opt"
-                                absolute_source_file = os.path.join(source_dir, source_file)
-                            pass
-                        referenced_files.append(absolute_source_file)
-                        if not os.path.exists(absolute_source_file):
-                            print(f"File does not exists: {absolute_source_file}")
-
-                if source_dir != "":
-                    items = digest_line(line, source_dir)
-                else:
-                    pass
-                    # print(f"Source was not on first line: {filename}")
-                referenced_files = referenced_files + items
-                num = num + 1
-                pass
-            pass
+        for rule_files in self.digest_depend_rules(filename):
+            referenced_files += rule_files
         return referenced_files
 
     def get_depend_files(self) -> List[FileName]:
@@ -341,6 +1088,61 @@ class DigestDepends:
             print(f"File does not exists: {file}")
         return file
 
+    def get_depend_rules(self) -> Dict[FileName, List[FileName]]:
+        """ Return a dictionary from each source file found in a .d file to its dependencies. """
+        rules: Dict[FileName, List[FileName]] = {}
+        for file in self.get_depend_files():
+            for rule_files in self.digest_depend_rules(file):
+                rules.setdefault(rule_files[0], []).extend(rule_files[1:])
+        return rules
+
+    def build_include_graph(self) -> IncludeGraph:
+        """ Build the dependency graph of the files referenced by the .d files.
+
+        Each source has an edge to exactly the dependencies its .d file lists. Each
+        other referenced file has an edge to the referenced files its #include
+        directives name. Where an include matches several of them, only those listed
+        in the .d file of a source that depends on the including file are kept, and of
+        those one in the including file's own directory is preferred. An include still
+        left with several candidates gets no edge and is recorded in
+        self.graph_ambiguous_includes as [file, include, candidate, ...].
+
+        Every node is named by its os.path.realpath, as are the files queried from
+        the saved graph, so a file reached through different spellings is one node.
+        """
+        rules: Dict[FileName, List[FileName]] = {}
+        for source, deps in self.get_depend_rules().items():
+            rules.setdefault(os.path.realpath(source), []).extend(os.path.realpath(dep) for dep in deps)
+        referenced_files = get_unique_list([file for source, deps in rules.items() for file in [source] + deps])
+        # Sources' edges come from their .d files, so only the other files are scanned.
+        headers = [file for file in referenced_files if file not in rules]
+        include_map = extract_includes_by_file(headers)
+        index = PathSuffixIndex(referenced_files, get_max_components(union_includes(include_map, headers)))
+        # The sources whose .d files list each file.
+        sources_of: Dict[FileName, Set[FileName]] = {}
+        for source, deps in rules.items():
+            for dep in deps:
+                sources_of.setdefault(dep, set()).add(source)
+        edges = [(source, dep) for source, deps in rules.items() for dep in deps]
+        self.graph_ambiguous_includes: List[List[str]] = []
+        for file, includes in include_map.items():
+            file_dir = os.path.dirname(file)
+            file_sources = sources_of.get(file, set())
+            for include in sorted(includes):
+                candidates = index.paths_with_suffix(include)
+                if len(candidates) > 1:
+                    candidates = [candidate for candidate in candidates
+                                  if not file_sources.isdisjoint(sources_of.get(candidate, ()))]
+                if len(candidates) > 1:
+                    local = os.path.realpath(os.path.join(file_dir, include))
+                    if local in candidates:
+                        candidates = [local]
+                if len(candidates) > 1:
+                    self.graph_ambiguous_includes.append([file, include] + sorted(candidates))
+                elif candidates:
+                    edges.append((file, candidates[0]))
+        return IncludeGraph.from_edges(edges, rules.keys())
+
     def get_unique_depend_files(self) -> List[FileName]:
         """ Return sorted list of unique files referenced in the dependency files found in the root_directory tree.
 
@@ -349,8 +1151,7 @@ class DigestDepends:
         depend_files = self.get_depend_files()
         digested_contents = []
         for file in depend_files:
-            digested = self.digest_depend_file(file)
-            digested_contents = digested_contents + digested
+            digested_contents += self.digest_depend_file(file)
         unique_list = get_unique_list(digested_contents)
         return unique_list
 
@@ -365,8 +1166,9 @@ class DigestDepends:
         project_files: List[FileName] = []
         system_files = []
         length_project_root_dir: int = len(self.project_root_directory)
+        root_prefix = os.path.join(self.project_root_directory, '')
         for file in unique_list:
-            if file.startswith(self.project_root_directory):
+            if file.startswith(root_prefix):
                 file = file[length_project_root_dir + 1:]
                 project_files.append(file)
             else:
@@ -393,17 +1195,16 @@ class DigestDepends:
         project_root = self.project_root_directory
         len_root = len(project_root)
         abs_project_directories = [os.path.join(project_root, proj_dir) for proj_dir in project_directories]
-        all_include_directories = abs_project_directories + system_directories
+        all_include_directories = get_unique_list(abs_project_directories + system_directories)
+        include_map = map_includes_to_directories(all_includes, all_include_directories)
         result = []
         for include in all_includes:
             resolutions = set()
-            for inc_dir in all_include_directories:
-                candidate = os.path.join(inc_dir, include)
-                if os.path.isfile(candidate):
-                    candidate = os.path.realpath(candidate)
-                    if candidate.startswith(project_root):
-                        candidate = candidate[len_root+1:]
-                    resolutions.add(candidate)
+            for inc_dir in include_map.get(include, []):
+                candidate = os.path.realpath(os.path.join(inc_dir, include))
+                if candidate.startswith(project_root):
+                    candidate = candidate[len_root+1:]
+                resolutions.add(candidate)
             if len(resolutions) > 1:
                 sublist = [include]
                 resolutions_list = [r for r in resolutions]
@@ -422,6 +1223,44 @@ class DigestDepends:
                 w.write(line + '\n')
         pass
 
+    def process_include_order(self, options_filename: FileName,
+                              system_directories: List[DirectoryName] = None) -> None:
+        """ Report the headers each translation unit of a Polyspace options file really gets.
+
+        The compiler's search of the -I directories is simulated for each source, so
+        an include found in several directories resolves to the first one only. Writes:
+        - uniqued-tu-headers: "source: header" for each header a source pulls in
+        - uniqued-tu-shadowed: [source, includer, include, header, shadowed...] where a
+          directive matched more than one file
+        - uniqued-tu-unresolved: "source: includer: include" for directives with no match
+
+        :param options_filename: Polyspace options file giving each source's -I order
+        :param system_directories: Directories searched after each source's -I list
+        """
+        include_order = read_polyspace_include_order(options_filename)
+        simulator = IncludeSearchSimulator(system_directories)
+        tu_headers = []
+        tu_shadowed = []
+        tu_unresolved = []
+        for source in sorted(include_order):
+            records = simulator.simulate(source, include_order[source])
+            headers = set()
+            shadowed_set = set()
+            unresolved_set = set()
+            for includer, include, header, shadowed in records:
+                if header is None:
+                    unresolved_set.add(f"{source}: {includer}: {include}")
+                    continue
+                headers.add(header)
+                if len(shadowed) > 0:
+                    shadowed_set.add(str([source, includer, include, header] + shadowed))
+            tu_headers += [f"{source}: {header}" for header in sorted(headers)]
+            tu_shadowed += sorted(shadowed_set)
+            tu_unresolved += sorted(unresolved_set)
+        self.write_lines_with_newline("uniqued-tu-headers", tu_headers)
+        self.write_lines_with_newline("uniqued-tu-shadowed", tu_shadowed)
+        self.write_lines_with_newline("uniqued-tu-unresolved", tu_unresolved)
+
     def process_depend_files(self) -> None:
         """ Main program for processing .depend files.
 
@@ -431,18 +1270,73 @@ class DigestDepends:
           analyses that do look at everything in the source directories.
         """
         referenced_files = self.get_unique_depend_files()
+        self.process_referenced_files(referenced_files)
+
+    def process_compile_database(self, database_filename: FileName,
+                                 system_directories: List[DirectoryName] = None,
+                                 max_workers: int = None) -> None:
+        """ Main program for processing a compile database (compile_commands.json).
+
+        The files each translation unit references are found by following its
+        #include directives with its own -I order, instead of from .d files, and
+        the same reports as process_depend_files are written.
+
+        :param database_filename: The compile_commands.json file
+        :param system_directories: Directories searched after each entry's own include options
+        :param max_workers: Number of scanning threads, or None for the default
+        """
+        # One simulator is shared by all threads, so each header is scanned only once.
+        simulator = IncludeSearchSimulator(system_directories)
+
+        def referenced_by_entry(entry: Tuple[FileName, List[DirectoryName], List[DirectoryName],
+                                             List[DirectoryName]]) -> Set[FileName]:
+            source, quote_directories, include_directories, after_directories = entry
+            files = {source}
+            for includer, include, header, shadowed in simulator.simulate(source, include_directories,
+                                                                          after_directories, quote_directories):
+                if header is not None:
+                    files.add(header)
+            return files
+
+        entries = (get_compile_entry_includes(entry) for entry in iter_json_array(database_filename))
+        referenced = set()
+        if max_workers is None:
+            # The ThreadPoolExecutor default.
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        # Only keep a bounded number of entries in flight, so the streaming parse of the
+        # database is not undone by queueing every entry at once.
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for entry in entries:
+                if len(pending) >= max_workers * ENTRIES_IN_FLIGHT_PER_THREAD:
+                    referenced.update(pending.popleft().result())
+                pending.append(executor.submit(referenced_by_entry, entry))
+            while pending:
+                referenced.update(pending.popleft().result())
+        referenced_files = sorted({os.path.realpath(file) for file in referenced})
+        self.process_referenced_files(referenced_files)
+
+    def process_referenced_files(self, referenced_files: List[FileName]) -> None:
+        """ Write the uniqued-* reports for the sorted, absolute list of files used by the build. """
         self.write_lines_with_newline("referenced_files", referenced_files)
         extensions = get_source_extensions(referenced_files)
-        all_includes = extract_includes_from_files(referenced_files)
-        all_includes_filtered = filter_includes(all_includes, referenced_files)
+        # Scan every referenced file once and derive the per-group include sets from that.
+        include_map = extract_includes_by_file(referenced_files)
+        all_includes = union_includes(include_map, referenced_files)
+        # One suffix index over the referenced files serves all three filter passes, since
+        # the project and system includes are subsets of all_includes.
+        referenced_index = PathSuffixIndex(referenced_files, get_max_components(all_includes))
+        all_includes_filtered = filter_includes(all_includes, referenced_files, referenced_index)
         self.write_lines_with_newline("uniqued-includes", all_includes_filtered)
         how_included = get_how_included(all_includes_filtered)
         project_files, system_files = self.separate_system_and_project_files(referenced_files)
-        project_includes = extract_includes_from_files(project_files)
-        project_includes_filtered = filter_includes(project_includes, referenced_files)
+        # project_files are root-relative, so map them back to the referenced (absolute) names.
+        abs_project_files = [os.path.join(self.project_root_directory, file) for file in project_files]
+        project_includes = union_includes(include_map, abs_project_files)
+        project_includes_filtered = filter_includes(project_includes, referenced_files, referenced_index)
         self.write_lines_with_newline("uniqued-project-includes", project_includes_filtered)
-        system_includes = extract_includes_from_files(system_files)
-        system_includes_filtered = filter_includes(system_includes, referenced_files)
+        system_includes = union_includes(include_map, system_files)
+        system_includes_filtered = filter_includes(system_includes, referenced_files, referenced_index)
         self.write_lines_with_newline("uniqued-system-includes", system_includes_filtered)
         # self.write_lines_with_newline("uniqued-depends", referenced_files)
         self.write_lines_with_newline("uniqued-projfiles", project_files)
@@ -460,11 +1354,78 @@ class DigestDepends:
         self.write_lines_with_newline("uniqued-all-sources", all_source_files)
         unused_files = get_unused_files(all_source_files, project_files)
         self.write_lines_with_newline("uniqued-unused-sources", unused_files)
-        pass
+        unused_by_directory = summarize_by_directory(unused_files, self.project_root_directory)
+        self.write_lines_with_newline("uniqued-unused-by-dir", unused_by_directory)
+
+
+def usage():
+    """ Usage:
+    python3 digestDepends.py [--source-dirs name[,name]...] [--include-order poly_options_file [system_dir]...]
+    python3 digestDepends.py [--source-dirs name[,name]...] --build-graph graph_file
+    python3 digestDepends.py --compile-commands compile_commands.json [system_dir]...
+    python3 digestDepends.py --graph graph_file (--closure|--dependents|--tus) file...
+
+    Without options, find the .d files (as produced by gcc -MMD) under the current
+    directory and write the uniqued-* reports about the files they reference.
+    When a .d file's object is "../dir/file.o", its source is looked for in the
+    --source-dirs directories (default "src,src_opt") beside "dir".
+
+    With --include-order, simulate the compiler's include search for each source
+    of the Polyspace options file, using its -I options in order followed by the
+    given system directories, and write the uniqued-tu-* reports.
+
+    With --compile-commands, find the files each translation unit of a compile
+    database references by following its #include directives with its own include
+    options (followed by the given system directories), instead of reading .d
+    files, and write the same uniqued-* reports.
+
+    With --build-graph, build the include graph of the files referenced by the
+    .d files and save it to graph_file, listing the #include directives that
+    could not be resolved to a single file. With --graph, load a saved graph and
+    print the transitive dependencies of the given files (--closure), the files
+    that depend on them (--dependents) or the translation units that pull them
+    in (--tus).
+    """
+    print(usage.__doc__)
+    sys.exit(1)
 
 
 if __name__ == u'__main__':
-    print('Digesting dependency files\n')
-    digester = DigestDepends(os.getcwd(), '')
-    digester.process_depend_files()
+    options = sys.argv[1:]
+    source_directory_names = None
+    if len(options) >= 2 and options[0] == '--source-dirs':
+        source_directory_names = options[1].split(',')
+        options = options[2:]
+    digester = DigestDepends(os.getcwd(), '', source_directory_names)
+    if len(options) == 0:
+        print('Digesting dependency files\n')
+        digester.process_depend_files()
+    elif options[0] == '--include-order' and len(options) >= 2:
+        print('Simulating include search order\n')
+        digester.process_include_order(options[1], options[2:])
+    elif options[0] == '--compile-commands' and len(options) >= 2:
+        print('Digesting compile database\n')
+        digester.process_compile_database(options[1], options[2:])
+    elif options[0] == '--build-graph' and len(options) == 2:
+        print('Building include graph\n')
+        graph = digester.build_include_graph()
+        graph.save(options[1])
+        for ambiguous in digester.graph_ambiguous_includes:
+            print(f"Ambiguous include {ambiguous[1]} in {ambiguous[0]}: {' '.join(ambiguous[2:])}")
+        print(f"{len(graph.names)} files, {len(graph.targets)} dependencies")
+    elif options[0] == '--graph' and len(options) >= 4:
+        graph = IncludeGraph.load(options[1])
+        files = [os.path.realpath(file) for file in options[3:]]
+        if options[2] == '--closure':
+            results = graph.closure(files)
+        elif options[2] == '--dependents':
+            results = graph.dependents(files)
+        elif options[2] == '--tus':
+            results = graph.dependent_translation_units(files)
+        else:
+            usage()
+        for result in results:
+            print(result)
+    else:
+        usage()
     print('\ndone.\n')
@@ -2,7 +2,8 @@
 import os
 import re
 import sys
-from typing import Dict, List, Set
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict
 
 DirectoryName = str
@@ -11,175 +12,393 @@ FileName = str
 
 def usage():
     print(""" Usage:
-    python factoroptions.py input-options-filename
+    python factoroptions.py [--intersection|--hierarchical] [--streaming] [--check] input-options-filename
+
+    By default every option of every -options-for-sources line is factored out
+    (union). With --intersection only the options shared by all lines are.
+    With --hierarchical the .factored file is written as with --intersection,
+    and the options shared by all files of each directory subtree are also
+    reported in input-options-filename.subtrees.
+
+    With --streaming the input is read twice, once to find the common options
+    and once to write the .factored file, instead of being held in memory.
+
+    With --check the .factored file is read back and each source's options are
+    rebuilt from it and compared with the input.
     """)
     sys.exit(1)
 
 
-def get_includes(line: str) -> Set[str]:
-    """ Return the set of Include options from the -options-for-sources line. """
-    parts = line.split(";")
-    # parts[0] has the -options-for-sources and the source file.
-    includes = {part for part in parts
-                if (part.startswith("-I ") and not part.startswith("-I /usr"))}
-    return includes
+class OptionBitsets:
+    """ Intern option tokens as bit positions so option sets can be combined with integer operations.
+
+    Each distinct token is split out and classified once, when first seen. A set of
+    options is then an int with one bit per token, so unions, intersections and
+    differences are |, & and & ~.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.tokens: List[str] = []
+        # Bits of the "-I" options outside /usr, of the "-I /usr" options and of everything else.
+        self.include_mask = 0
+        self.usr_include_mask = 0
+        self.other_mask = 0
+
+    def intern(self, token: str) -> int:
+        """ Return the bit position of a token, assigning and classifying a new one if needed. """
+        token_id = self.ids.get(token)
+        if token_id is None:
+            token_id = len(self.tokens)
+            self.ids[token] = token_id
+            self.tokens.append(token)
+            bit = 1 << token_id
+            if token.startswith("-I /usr"):
+                self.usr_include_mask |= bit
+            elif token.startswith("-I "):
+                self.include_mask |= bit
+            else:
+                self.other_mask |= bit
+        return token_id
+
+    def intern_all(self, tokens: List[str]) -> Tuple[List[int], int]:
+        """ Return the ids of the tokens, in order, and the bitset of the tokens. """
+        ids = [self.intern(token) for token in tokens]
+        mask = 0
+        for token_id in ids:
+            mask |= 1 << token_id
+        return ids, mask
+
+    def to_set(self, mask: int) -> Set[str]:
+        """ Return the set of tokens whose bits are set in mask. """
+        tokens = self.tokens
+        # Walk the binary digits lowest bit first rather than shifting a large int.
+        bits = bin(mask)[:1:-1]
+        return {tokens[token_id] for token_id, bit in enumerate(bits) if bit == '1'}
+
 
+class DirectoryCache:
+    """ Memoized os.path.isdir results.
 
-def get_usr_includes(line: str) -> Set[str]:
-    """ Return the set of Include options from the -options-for-sources line. """
-    parts = line.split(";")
-    # parts[0] has the -options-for-sources and the source file.
-    includes = {part for part in parts if part.startswith("-I /usr")}
-    return includes
+    Include directories are often on network mounts, so the candidates are stat'ed
+    once, concurrently, by prefetch, and every later check is a dict lookup.
+    """
 
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+        self.is_dir: Dict[DirectoryName, bool] = {}
 
-def get_non_includes(line: str) -> Set[str]:
-    """ Return the set of non-Include options from the -options-for-sources line. """
-    parts = line.split(";")
-    # parts[0] has the -options-for-sources and the source file.
-    others = {part for part in parts[1:] if not part.startswith("-I ")}
-    return others
+    def prefetch(self, paths: Iterable[DirectoryName]) -> None:
+        """ Check all the paths not yet known using a thread pool. """
+        unknown = sorted(set(path for path in paths if path not in self.is_dir))
+        if not unknown:
+            return
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for path, is_dir in zip(unknown, executor.map(os.path.isdir, unknown)):
+                self.is_dir[path] = is_dir
+
+    def isdir(self, path: DirectoryName) -> bool:
+        is_dir = self.is_dir.get(path)
+        if is_dir is None:
+            is_dir = os.path.isdir(path)
+            self.is_dir[path] = is_dir
+        return is_dir
 
 
 class FactorOptions:
     """ Digest .depend files"""
 
-    def __init__(self, input_filename):
+    def __init__(self, input_filename, mode: str = "union", streaming: bool = False):
+        """ Initialize a FactorOptions object.
+
+        :param input_filename: The Polyspace options file
+        :param mode: "union" to factor out every option, "intersection" to factor out
+        only the options common to all files, or "hierarchical" to factor out those and
+        also find the options common to each directory subtree.
+        :param streaming: If True, do not keep the input lines. The common options are
+        found in a first pass over the file and output_factored re-reads it.
+        """
         self.input_filename = input_filename
+        self.mode = mode
+        self.streaming = streaming
         self.output_filename = input_filename + ".factored"
         self.includes_filename = input_filename + ".includes"
         self.defines_filename = input_filename + ".defines"
-        self.lines = self.read_input
-        # Collect the -options-for-sources lines.
-        self.ofs_lines = [line for line in self.lines if line.startswith("-options-for-sources ")]
-        common_includes = get_includes(self.ofs_lines[0])
-        common_usr_includes = get_usr_includes(self.ofs_lines[0])
-        common_other = get_non_includes(self.ofs_lines[0])
-        print(f"len(common_includes) = {len(common_includes)}")
-        print(f"len(common_usr_includes) = {len(common_usr_includes)}")
-        print(f"len(common_other) = {len(common_other)}")
-        for i in range(1, len(self.ofs_lines)):
-            this_includes = get_includes(self.ofs_lines[i])
-            common_includes = common_includes.union(this_includes)
-            print(f"len(common_includes) = {len(common_includes)}")
-            this_usr_includes = get_usr_includes(self.ofs_lines[i])
-            common_usr_includes = common_usr_includes.union(this_usr_includes)
-            print(f"len(common_usr_includes) = {len(common_usr_includes)}")
-            this_other = get_non_includes((self.ofs_lines[i]))
-            common_other = common_other.union(this_other)
-            print(f"len(common_other) = {len(common_other)}")
-
-        self.common_includes = common_includes
-        self.common_usr_includes = common_usr_includes
-        self.common_other = common_other
-        self.factored = self.compute_output()
+        self.subtrees_filename = input_filename + ".subtrees"
+        self.lines: List[str] = [] if streaming else self.read_input
+        # Split every -options-for-sources line once, folding its option bitset into the
+        # common options (and, for hierarchical factoring, into those of its directory).
+        # Unless streaming, also keep the lines, sources and option ids for compute_output.
+        self.bitsets = OptionBitsets()
+        self.ofs_lines: List[str] = []
+        self.first_ofs_line = ''
+        self.ofs_count = 0
+        self.ofs_sources: List[str] = []
+        self.ofs_ids: List[List[int]] = []
+        self.common_mask = 0
+        dir_masks: Dict[DirectoryName, int] = {}
+        for line in self.iter_input() if streaming else self.lines:
+            if not line.startswith("-options-for-sources "):
+                continue
+            parts = line.split(";")
+            ids, mask = self.bitsets.intern_all(parts[1:])
+            if self.ofs_count == 0:
+                self.first_ofs_line = line
+                self.common_mask = mask
+            elif self.mode == "union":
+                self.common_mask |= mask
+            else:
+                self.common_mask &= mask
+            self.ofs_count += 1
+            if self.mode == "hierarchical":
+                the_dir = os.path.dirname(parts[0][len("-options-for-sources "):])
+                dir_masks[the_dir] = dir_masks[the_dir] & mask if the_dir in dir_masks else mask
+            if not streaming:
+                self.ofs_lines.append(line)
+                self.ofs_sources.append(parts[0])
+                self.ofs_ids.append(ids)
+
+        self.subtree_masks = self.compute_subtree_masks(dir_masks)
+        self.common_includes = self.bitsets.to_set(self.common_mask & self.bitsets.include_mask)
+        self.common_usr_includes = self.bitsets.to_set(self.common_mask & self.bitsets.usr_include_mask)
+        self.common_other = self.bitsets.to_set(self.common_mask & self.bitsets.other_mask)
+        print(f"len(common_includes) = {len(self.common_includes)}")
+        print(f"len(common_usr_includes) = {len(self.common_usr_includes)}")
+        print(f"len(common_other) = {len(self.common_other)}")
+        # Stat all the candidate include directories up front.
+        self.dir_cache = DirectoryCache()
+        self.dir_cache.prefetch(include[3:] for include in self.common_includes | self.common_usr_includes)
+        self.factored: List[str] = [] if streaming else self.compute_output()
         pass
 
+    @staticmethod
+    def compute_subtree_masks(dir_masks: Dict[DirectoryName, int]) -> Dict[DirectoryName, int]:
+        """ Return, for each directory holding or above a source, the options common to its subtree.
+
+        :param dir_masks: The options common to the sources of each directory
+        """
+        subtree_masks = dict(dir_masks)
+        all_dirs: Set[DirectoryName] = set()
+        for the_dir in subtree_masks:
+            while the_dir not in all_dirs:
+                all_dirs.add(the_dir)
+                the_dir = os.path.dirname(the_dir)
+        # Fold each directory into its parent, deepest first, so a parent is complete
+        # before it is folded in turn.
+        for the_dir in sorted(all_dirs, key=lambda d: d.count('/'), reverse=True):
+            parent = os.path.dirname(the_dir)
+            if parent == the_dir:
+                continue
+            if parent in subtree_masks:
+                subtree_masks[parent] &= subtree_masks[the_dir]
+            else:
+                subtree_masks[parent] = subtree_masks[the_dir]
+        return subtree_masks
+
+    def iter_input(self) -> Iterator[str]:
+        with open(self.input_filename, 'r') as f:
+            for line in f:
+                yield line.strip("\\\n")
+
     @property
     def read_input(self) -> List[str]:
-        with open(self.input_filename, 'r') as f:
-            lines = [line.strip("\\\n") for line in f]
-            return lines
-
-    def is_common(self, arg):
-        if arg in self.common_includes:
-            return True
-        if arg in self.common_usr_includes:
-            return True
-        return arg in self.common_other
-
-    def compute_new_ofs(self, ofs_index) -> str:
-        line = self.ofs_lines[ofs_index]
-        parts = line.split(";")
-        args = []
-        for i in range(1, len(parts)):
-            arg = parts[i]
-            if not self.is_common(arg):
-                args.append(arg)
+        return list(self.iter_input())
+
+    def compute_new_ofs(self, source: str, ids: List[int]) -> str:
+        # Only the options common to all lines are factored out. Those common to a
+        # subtree stay on its lines, since the options file cannot apply them to it.
+        common_mask = self.common_mask
+        tokens = self.bitsets.tokens
+        args = [tokens[token_id] for token_id in ids
+                if not (common_mask >> token_id) & 1]
         if args:
             argstring = ';'.join(args)
-            result = ':'.join([parts[0], argstring])
+            result = ':'.join([source, argstring])
             return result
         return ''
 
     def get_common_usr_include_list(self) -> List[str]:
-        # Preserve the order from the first.
-        line = self.ofs_lines[0]
-        parts = line.split(";")
+        # Preserve the order from the first. With union factoring, the ones the first
+        # line does not have follow in sorted order.
+        line = self.first_ofs_line
+        parts = line.split(";")[1:]
+        first_parts = set(parts)
+        parts += sorted(include for include in self.common_usr_includes if include not in first_parts)
         result = []
-        for i in range(1, len(parts)):
-            part = parts[i]
+        for part in parts:
             if part in self.common_usr_includes:
-                if os.path.isdir(part[3:]):
+                if self.dir_cache.isdir(part[3:]):
                     result.append(part)
                 else:
                     print(part + " is not a directory")
         return result
 
     def compute_output(self) -> List[str]:
-        factored_lines = []
+        return list(self.iter_factored(self.lines))
+
+    def iter_factored(self, lines: Iterable[str]) -> Iterator[str]:
+        """ Yield the factored form of the input lines. """
         ofs_index = 0
-        for line in self.lines:
+        for line in lines:
             if line.startswith("-options-for-sources "):
-                factored = self.compute_new_ofs(ofs_index)
+                if self.streaming:
+                    # Every token was interned by the first pass.
+                    parts = line.split(";")
+                    source = parts[0]
+                    ids = [self.bitsets.ids[part] for part in parts[1:]]
+                else:
+                    source = self.ofs_sources[ofs_index]
+                    ids = self.ofs_ids[ofs_index]
+                factored = self.compute_new_ofs(source, ids)
                 if factored:
-                    factored_lines.append(factored)
+                    yield factored
                 ofs_index += 1
                 pass
             else:
-                if ofs_index == len(self.ofs_lines):
+                if ofs_index == self.ofs_count:
                     # We have processed the last ofs line. Output common.
-                    factored_lines += ["# Start of factored options"]
-                    # First the non-/usr includes.
-                    sorted_includes = [include for include in self.common_includes
-                                       if os.path.isdir(include[3:])]
-                    sorted_includes.sort()
-                    factored_lines += sorted_includes
-                    # Next the /usr includes.
-                    factored_lines += self.get_common_usr_include_list()
-                    # Now the others. Let's sort them too.
-                    sorted_others = [other for other in self.common_other]
-                    sorted_others.sort()
-                    factored_lines += sorted_others
+                    yield from self.iter_common_options()
                     # increment ofs_index so we don't do this again.
                     ofs_index += 1
-                    factored_lines += ["# End of factored options"]
 
                 # One of the original lines.
-                factored_lines.append(line)
+                yield line
                 pass
-        return factored_lines
+        if ofs_index == self.ofs_count:
+            # The input ended with an ofs line.
+            yield from self.iter_common_options()
+
+    def iter_common_options(self) -> Iterator[str]:
+        """ Yield the block of factored options. """
+        yield "# Start of factored options"
+        # First the non-/usr includes.
+        sorted_includes = [include for include in self.common_includes
+                           if self.dir_cache.isdir(include[3:])]
+        sorted_includes.sort()
+        yield from sorted_includes
+        # Next the /usr includes.
+        yield from self.get_common_usr_include_list()
+        # Now the others. Let's sort them too.
+        sorted_others = [other for other in self.common_other]
+        sorted_others.sort()
+        yield from sorted_others
+        yield "# End of factored options"
 
     def output_factored(self):
+        factored = self.iter_factored(self.iter_input()) if self.streaming else self.factored
         with open(self.output_filename, "w") as w:
-            for line in self.factored:
+            for line in factored:
                 w.write(line + '\n')
         pass
 
     def output_defines(self):
         with open(self.defines_filename, "w") as w:
-            for line in self.common_other:
+            for line in sorted(self.common_other):
                 w.write(line + '\n')
         pass
 
 
+    def output_subtrees(self):
+        """ Write the options common to each directory subtree beyond those of the enclosing subtree.
+
+        This is a report; the options stay on the lines of the .factored file.
+        """
+        with open(self.subtrees_filename, "w") as w:
+            for the_dir in sorted(self.subtree_masks):
+                parent = os.path.dirname(the_dir)
+                if parent != the_dir and parent in self.subtree_masks:
+                    enclosing_mask = self.subtree_masks[parent]
+                else:
+                    enclosing_mask = self.common_mask
+                extra = self.subtree_masks[the_dir] & ~enclosing_mask
+                if extra:
+                    w.write(f"# Options common to {the_dir}\n")
+                    for option in sorted(self.bitsets.to_set(extra)):
+                        w.write(option + '\n')
+        pass
+
     def output_includes(self):
         with open(self.includes_filename, "w") as w:
-            for line in self.common_usr_includes:
+            for line in sorted(self.common_usr_includes):
                 w.write(line + '\n')
-            for line in self.common_includes:
+            for line in sorted(self.common_includes):
                 w.write(line + '\n')
         pass
 
+    def check_factored(self) -> int:
+        """ Rebuild each source's options from the .factored file and compare them with the input.
+
+        A source gets the factored options plus those left on its line. Common
+        includes that are not directories are left out of the factored options on
+        purpose, so they are not reported. With union factoring a source may get
+        options it did not have; with the other modes the options must match.
+
+        :return: The number of sources whose options do not match.
+        """
+        factored_options = set()
+        residual_lines = []
+        in_factored = False
+        with open(self.output_filename, 'r') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line == "# Start of factored options":
+                    in_factored = True
+                elif line == "# End of factored options":
+                    in_factored = False
+                elif in_factored:
+                    factored_options.add(line)
+                elif line.startswith("-options-for-sources "):
+                    residual_lines.append(line)
+        omitted = {include for include in self.common_includes | self.common_usr_includes
+                   if not self.dir_cache.isdir(include[3:])}
+        mismatches = 0
+        residual_index = 0
+        for line in self.iter_input():
+            if not line.startswith("-options-for-sources "):
+                continue
+            parts = line.split(";")
+            options = factored_options.copy()
+            prefix = parts[0] + ':'
+            if residual_index < len(residual_lines) and residual_lines[residual_index].startswith(prefix):
+                options.update(residual_lines[residual_index][len(prefix):].split(";"))
+                residual_index += 1
+            original = set(parts[1:]) - omitted
+            missing = original - options
+            extra = options - original - omitted if self.mode != "union" else set()
+            if missing or extra:
+                mismatches += 1
+                print(f"{parts[0]}: missing {sorted(missing)}, extra {sorted(extra)}")
+        return mismatches
+
 
 if __name__ == u'__main__':
     print('Factoring PolySpace Code Prover options\n')
-    options = sys.argv
-    if len(sys.argv) != 2:
+    options = sys.argv[1:]
+    mode = "union"
+    streaming = False
+    check = False
+    while len(options) > 1 and options[0].startswith("--"):
+        if options[0] in ("--intersection", "--hierarchical"):
+            mode = options[0][2:]
+        elif options[0] == "--streaming":
+            streaming = True
+        elif options[0] == "--check":
+            check = True
+        else:
+            usage()
+        options = options[1:]
+    if len(options) != 1:
         usage()
 
-    factor = FactorOptions(options[1])
+    factor = FactorOptions(options[0], mode, streaming)
     factor.output_factored()
     factor.output_defines()
     factor.output_includes()
+    if mode == "hierarchical":
+        factor.output_subtrees()
+    if check:
+        mismatches = factor.check_factored()
+        print(f"{mismatches} sources do not get their original options from {factor.output_filename}")
+        if mismatches:
+            sys.exit(1)
     print('\ndone.\n')
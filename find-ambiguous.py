@@ -1,71 +1,697 @@
 # Program to digest make depend files
+import fnmatch
+import gzip
+import hashlib
+import json
 import os
 import re
 import sys
-from typing import List, Set
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
 
 DirectoryName = str
 FileName = str
 
 
+class TreeWalker:
+    """
+    Walk a directory tree with os.scandir, splitting the top-level subtrees
+    across a thread pool. Directory reads and stats are dominated by file system
+    latency (especially over NFS), which threads overlap.
+    """
+
+    def __init__(self, pattern, follow_symlinks: bool = False,
+                 exclude_globs: List[str] = None, max_workers: int = None):
+        """ Initialize a TreeWalker.
+
+        :param pattern: Compiled regular expression a file's basename must match
+        :param follow_symlinks: Whether to descend into symbolic links to directories
+        :param exclude_globs: Directory basename globs (e.g. ".git") that are not entered
+        :param max_workers: Number of threads, or None for the ThreadPoolExecutor default
+        """
+        self.pattern = pattern
+        self.follow_symlinks = follow_symlinks
+        self.exclude_globs = exclude_globs or []
+        self.max_workers = max_workers
+
+    def is_excluded(self, name: str) -> bool:
+        for glob in self.exclude_globs:
+            if fnmatch.fnmatch(name, glob):
+                return True
+        return False
+
+    def enter(self, path: DirectoryName, chain: Tuple[str, ...]) -> Tuple[str, ...]:
+        """
+        Return the chain of real paths to pass to the subdirectories of path, given
+        the chain of its parent, or None if following links has made path its own
+        ancestor. Without following links there are no loops and the chain stays empty.
+        """
+        if not self.follow_symlinks:
+            return chain
+        real = os.path.realpath(path)
+        if real in chain:
+            return None
+        return chain + (real,)
+
+    def get_chain(self, root_dir: DirectoryName, path: DirectoryName) -> Tuple[str, ...]:
+        """ Return the chain of real paths for the subdirectories of path, a directory under root_dir. """
+        if not self.follow_symlinks:
+            return ()
+        chain = (os.path.realpath(root_dir),)
+        relative = os.path.relpath(path, root_dir)
+        if relative != os.curdir:
+            for name in relative.split(os.sep):
+                root_dir = os.path.join(root_dir, name)
+                chain = chain + (os.path.realpath(root_dir),)
+        return chain
+
+    def select_dirs(self, root_dir: DirectoryName, dirs: List[DirectoryName]) -> List[DirectoryName]:
+        """
+        Return dirs with only one path kept for each real directory reached through
+        several, so its files are reported once. The kept path is chosen independently
+        of the order of the walk: a path that follows no links if there is one,
+        otherwise the lexicographically smallest.
+        """
+        if not self.follow_symlinks:
+            return list(dirs)
+        real_root = os.path.realpath(root_dir)
+        chosen: Dict[str, Tuple[bool, DirectoryName]] = {}
+        for path in dirs:
+            real = os.path.realpath(path)
+            relative = os.path.relpath(path, root_dir)
+            follows_links = os.path.normpath(os.path.join(real_root, relative)) != real
+            key = (follows_links, path)
+            if real not in chosen or key < chosen[real]:
+                chosen[real] = key
+        return sorted([path for follows_links, path in chosen.values()])
+
+    def scan_dir(self, path: DirectoryName) -> Tuple[List[DirectoryName], List[str]]:
+        """ Return the subdirectories to enter and the matching file names of one directory. """
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=self.follow_symlinks):
+                            if not self.is_excluded(entry.name):
+                                subdirs.append(entry.path)
+                        elif entry.is_file():
+                            if self.pattern.match(entry.name):
+                                files.append(entry.name)
+                    except OSError:
+                        pass
+        except OSError as err:
+            print(f"Cannot read directory {path}: {err}")
+        return subdirs, files
+
+    def walk_subtree(self, top: DirectoryName, chain: Tuple[str, ...]) -> Dict[DirectoryName, List[str]]:
+        """ Return a directory -> matching file names map for the directories under top. """
+        dir_files: Dict[DirectoryName, List[str]] = {}
+        stack = [(top, chain)]
+        while stack:
+            path, chain = stack.pop()
+            chain = self.enter(path, chain)
+            if chain is None:
+                continue
+            subdirs, files = self.scan_dir(path)
+            dir_files[path] = files
+            # Reverse so the subdirectories are visited in listing order.
+            stack.extend((subdir, chain) for subdir in reversed(subdirs))
+        return dir_files
+
+    def walk(self, root_dir: DirectoryName) -> Dict[str, List[FileName]]:
+        """ Return a basename -> sorted paths map for the matching files under root_dir. """
+        chain = self.enter(root_dir, ())
+        subdirs, files = self.scan_dir(root_dir)
+        dir_files: Dict[DirectoryName, List[str]] = {root_dir: files}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for subtree_files in executor.map(lambda subdir: self.walk_subtree(subdir, chain), subdirs):
+                dir_files.update(subtree_files)
+        base_map: Dict[str, List[FileName]] = {}
+        for path in self.select_dirs(root_dir, list(dir_files)):
+            for name in dir_files[path]:
+                base_map.setdefault(name, []).append(os.path.join(path, name))
+        for paths in base_map.values():
+            paths.sort()
+        return base_map
+
+
+# A directory modified this close to (or after) the time a snapshot was taken is
+# rescanned anyway, since a later change within the file system's timestamp
+# granularity would not change its mtime.
+SNAPSHOT_MTIME_SLACK_NS = 2 * 1000 * 1000 * 1000
+
+
+def get_dir_mtime(path: DirectoryName) -> int:
+    """ Return a directory's mtime in nanoseconds, or None if it is gone. """
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class TreeSnapshot:
+    """
+    Record of a walked tree: for every directory, its mtime, the subdirectories
+    entered and the matching file names. A directory's mtime changes when entries
+    are added to, removed from or renamed in it, so on the next run only directories
+    whose mtime changed need to be listed again; the others are only stat'ed.
+    """
+
+    def __init__(self, walker: TreeWalker, root_dir: DirectoryName):
+        self.walker = walker
+        self.root_dir = root_dir
+        # Directory -> (mtime_ns, subdirectory names, matching file names)
+        self.records: Dict[DirectoryName, Tuple[int, List[str], List[str]]] = {}
+        self.time_ns = 0
+        # Basename -> paths that were ambiguous when the snapshot was saved.
+        self.ambiguous: Dict[str, List[FileName]] = {}
+        # Basename -> content versions of those paths, if they were compared.
+        self.versions: Dict[str, List[List[FileName]]] = {}
+        # Directories listed by the last update.
+        self.rescanned: Set[DirectoryName] = set()
+
+    def scan_record(self, path: DirectoryName):
+        """ Return the record for one directory, or None if it cannot be read. """
+        # Stat before listing, so a change made during the listing shows up next time.
+        mtime = get_dir_mtime(path)
+        if mtime is None:
+            return None
+        subdirs, files = self.walker.scan_dir(path)
+        return mtime, [os.path.basename(subdir) for subdir in subdirs], files
+
+    def walk_subtree(self, top: DirectoryName) -> Dict[DirectoryName, Tuple[int, List[str], List[str]]]:
+        records = {}
+        stack = [(top, self.walker.get_chain(self.root_dir, os.path.dirname(top)))]
+        while stack:
+            path, chain = stack.pop()
+            chain = self.walker.enter(path, chain)
+            if chain is None:
+                continue
+            record = self.scan_record(path)
+            if record is None:
+                continue
+            records[path] = record
+            stack.extend((os.path.join(path, name), chain) for name in reversed(record[1]))
+        return records
+
+    def walk_subtrees(self, tops: List[DirectoryName], executor) -> List[DirectoryName]:
+        """ Record the subtrees below tops and return the directories listed. """
+        listed = []
+        for records in executor.map(self.walk_subtree, tops):
+            self.records.update(records)
+            listed += records
+        return listed
+
+    def update(self) -> int:
+        """ Bring the records up to date with the tree and return the number of directories listed. """
+        start_ns = time.time_ns()
+        with ThreadPoolExecutor(max_workers=self.walker.max_workers) as executor:
+            if not self.records:
+                root_record = self.scan_record(self.root_dir)
+                if root_record is None:
+                    print(f"Cannot read directory {self.root_dir}")
+                    return 0
+                self.records[self.root_dir] = root_record
+                self.walk_subtrees([os.path.join(self.root_dir, name) for name in root_record[1]], executor)
+                self.rescanned = set(self.records)
+            else:
+                dirs = list(self.records)
+                mtimes = list(executor.map(get_dir_mtime, dirs))
+                stale_limit = self.time_ns - SNAPSHOT_MTIME_SLACK_NS
+                changed = [path for path, mtime in zip(dirs, mtimes)
+                           if mtime is not None and (mtime != self.records[path][0] or mtime >= stale_limit)]
+                for path, mtime in zip(dirs, mtimes):
+                    if mtime is None:
+                        del self.records[path]
+                new_subdirs = []
+                rescanned = []
+                for path, record in zip(changed, executor.map(self.scan_record, changed)):
+                    if record is None:
+                        del self.records[path]
+                        continue
+                    self.records[path] = record
+                    rescanned.append(path)
+                    new_subdirs += [os.path.join(path, name) for name in record[1]
+                                    if os.path.join(path, name) not in self.records]
+                rescanned += self.walk_subtrees(new_subdirs, executor)
+                self.rescanned = set(rescanned)
+        self.prune()
+        self.time_ns = start_ns
+        return len(self.rescanned)
+
+    def prune(self):
+        """ Drop the records of directories no longer reachable from the root. """
+        reachable = {}
+        stack = [self.root_dir]
+        while stack:
+            path = stack.pop()
+            record = self.records.get(path)
+            if record is None or path in reachable:
+                continue
+            reachable[path] = record
+            stack.extend(os.path.join(path, name) for name in record[1])
+        self.records = reachable
+
+    def get_base_map(self) -> Dict[str, List[FileName]]:
+        """ Return the basename -> sorted paths index of the recorded files. """
+        base_map: Dict[str, List[FileName]] = {}
+        for path in self.walker.select_dirs(self.root_dir, list(self.records)):
+            for name in self.records[path][2]:
+                base_map.setdefault(name, []).append(os.path.join(path, name))
+        for paths in base_map.values():
+            paths.sort()
+        return base_map
+
+    def save(self, filename: FileName, base_map: Dict[str, List[FileName]],
+             versions: Dict[str, List[List[FileName]]] = None):
+        """ Write the snapshot, with the ambiguous part of base_map and its content versions, as gzip'd JSON. """
+        self.ambiguous = {name: paths for name, paths in base_map.items() if len(paths) > 1}
+        self.versions = versions or {}
+        data = {"root": self.root_dir, "time_ns": self.time_ns,
+                "pattern": self.walker.pattern.pattern,
+                "follow_symlinks": self.walker.follow_symlinks,
+                "exclude": self.walker.exclude_globs,
+                "dirs": self.records, "ambiguous": self.ambiguous, "versions": self.versions}
+        temp_filename = filename + ".tmp"
+        with gzip.open(temp_filename, "wt", encoding="utf-8") as w:
+            json.dump(data, w, separators=(',', ':'))
+        os.replace(temp_filename, filename)
+
+    def load(self, filename: FileName) -> bool:
+        """ Read a saved snapshot; return False (leaving this one empty) if it does not apply. """
+        try:
+            with gzip.open(filename, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as err:
+            print(f"Cannot use snapshot {filename}: {err}")
+            return False
+        if data["root"] != self.root_dir or data["pattern"] != self.walker.pattern.pattern:
+            print(f"Snapshot {filename} was taken with a different directory or pattern; ignoring it")
+            return False
+        # Snapshots from before these settings were saved cannot be checked, so are not used.
+        if (data.get("follow_symlinks") != self.walker.follow_symlinks
+                or data.get("exclude") != self.walker.exclude_globs):
+            print(f"Snapshot {filename} was taken with different --follow-symlinks or --exclude options; ignoring it")
+            return False
+        self.records = {path: tuple(record) for path, record in data["dirs"].items()}
+        self.time_ns = data["time_ns"]
+        self.ambiguous = data["ambiguous"]
+        self.versions = data.get("versions", {})
+        return True
+
+
+# Bytes hashed by the partial hash; files no larger than this are fully hashed by it.
+PARTIAL_HASH_SIZE = 64 * 1024
+# Read size for full hashes.
+HASH_READ_SIZE = 1024 * 1024
+
+
+def get_file_size(path: FileName) -> int:
+    """ Return the size of a file, or -1 if it cannot be read. """
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return -1
+
+
+def hash_file(path: FileName, limit: int = None) -> str:
+    """ Return a hex digest of the first limit bytes of a file (all of it if limit is None). """
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            if limit is None and hasattr(os, 'posix_fadvise'):
+                # Ask the kernel to read ahead aggressively for this whole-file scan.
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            remaining = limit
+            while remaining is None or remaining > 0:
+                size = HASH_READ_SIZE if remaining is None else min(HASH_READ_SIZE, remaining)
+                chunk = f.read(size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                if remaining is not None:
+                    remaining -= len(chunk)
+    except OSError as err:
+        # Unreadable files never compare equal to anything.
+        return f"unreadable:{path}:{err}"
+    return digest.hexdigest()
+
+
+def partial_hash_file(path: FileName) -> str:
+    return hash_file(path, PARTIAL_HASH_SIZE)
+
+
+class ContentClassifier:
+    """
+    Split groups of same-named files into sets of identical copies.
+
+    Files are compared by size first, then by a hash of their first
+    PARTIAL_HASH_SIZE bytes, then by a hash of their whole content. A file is only
+    read when an earlier stage could not tell it apart from another file of its group.
+    """
+
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers
+
+    def refine(self, clusters: List[List[FileName]], key_function, executor,
+               keys: Dict[FileName, object]) -> List[List[FileName]]:
+        """ Split every cluster of more than one file by key_function, computed on the pool.
+
+        The computed keys are stored in keys.
+        """
+        candidates = [path for cluster in clusters if len(cluster) > 1 for path in cluster]
+        keys.update(zip(candidates, executor.map(key_function, candidates)))
+        result = []
+        for cluster in clusters:
+            if len(cluster) == 1:
+                result.append(cluster)
+                continue
+            by_key: Dict[object, List[FileName]] = {}
+            for path in cluster:
+                by_key.setdefault(keys[path], []).append(path)
+            result.extend(by_key.values())
+        return result
+
+    def classify(self, groups: Dict[str, List[FileName]]) -> Dict[str, List[List[FileName]]]:
+        """ Return, for each basename group, its files partitioned into sorted sets of identical content. """
+        sizes: Dict[FileName, int] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            clusters = self.refine(list(groups.values()), get_file_size, executor, sizes)
+            clusters = self.refine(clusters, partial_hash_file, executor, {})
+            # Clusters of small files were already hashed in full by the partial hash.
+            large = [cluster for cluster in clusters
+                     if len(cluster) > 1 and sizes[cluster[0]] > PARTIAL_HASH_SIZE]
+            done = [cluster for cluster in clusters
+                    if len(cluster) == 1 or sizes[cluster[0]] <= PARTIAL_HASH_SIZE]
+            clusters = done + self.refine(large, hash_file, executor, {})
+        result: Dict[str, List[List[FileName]]] = {name: [] for name in groups}
+        for cluster in clusters:
+            result[os.path.basename(cluster[0])].append(sorted(cluster))
+        for name in result:
+            result[name].sort()
+        return result
+
+
 class AmbiguousFinder:
     """
     Find files that exist in more than one subdirectory directory of a given directory.
     As input, give a file that is the result of 'find -type f'.
     """
 
-    def __init__(self, pattern: str, root_dir: DirectoryName, out_file: FileName):
-        """ Initialize a DigestDepends object. """
+    def __init__(self, pattern: str, root_dir: DirectoryName, out_file: FileName,
+                 follow_symlinks: bool = False, exclude_globs: List[str] = None, max_workers: int = None,
+                 compare_content: bool = False, output_format: str = "text"):
+        """ Initialize a DigestDepends object.
+
+        :param output_format: "text" for the human-readable report, or "jsonl" for
+        one JSON object per ambiguous file name.
+        """
         self.pattern = re.compile(pattern)
         self.root_dir = root_dir
         self.out_file = out_file
+        self.compare_content = compare_content
+        self.output_format = output_format
+        # Keep standard output clean when it carries the JSON lines.
+        self.verbose = out_file != "-" or output_format != "jsonl"
+        self.follow_symlinks = follow_symlinks
+        self.exclude_globs = exclude_globs
+        self.max_workers = max_workers
         self.file_list = []
         self.base_map = {}
+        # Ambiguities of the previous run, when running against a snapshot.
+        self.previous_ambiguous = None
+        # Content versions of the ambiguous files, once classified.
+        self.versions = None
         pass
 
     def find_files(self):
-        for root, dirs, files in os.walk(self.root_dir):
-            for file in files:
-                if self.pattern.match(file):
-                    self.file_list.append(os.path.join(root, file))
+        walker = TreeWalker(self.pattern, self.follow_symlinks, self.exclude_globs, self.max_workers)
+        self.base_map = walker.walk(self.root_dir)
+        self.file_list = [path for paths in self.base_map.values() for path in paths]
+        pass
+
+    def find_files_with_snapshot(self, snapshot_file: FileName):
+        """ Like find_files, but only list directories that changed since the snapshot was saved.
+
+        The snapshot is created on the first run and updated on every run. When a
+        previous snapshot was used, find_ambiguities reports the differences from it.
+        """
+        walker = TreeWalker(self.pattern, self.follow_symlinks, self.exclude_globs, self.max_workers)
+        snapshot = TreeSnapshot(walker, self.root_dir)
+        if os.path.exists(snapshot_file) and snapshot.load(snapshot_file):
+            self.previous_ambiguous = snapshot.ambiguous
+        listed = snapshot.update()
+        if self.verbose:
+            print(f"Listed {listed} of {len(snapshot.records)} directories")
+        self.base_map = snapshot.get_base_map()
+        self.file_list = [path for paths in self.base_map.values() for path in paths]
+        if self.compare_content:
+            previous_versions = snapshot.versions if self.previous_ambiguous is not None else {}
+            self.versions = self.get_versions(self.base_map, previous_versions, snapshot.rescanned)
+        snapshot.save(snapshot_file, self.base_map, self.versions)
+        pass
+
+    def get_versions(self, file_map: Dict[str, List[FileName]],
+                     previous_versions: Dict[str, List[List[FileName]]] = None,
+                     rescanned: Set[DirectoryName] = None) -> Dict[str, List[List[FileName]]]:
+        """ Return the content versions of each ambiguous group of file_map.
+
+        A group with the same paths as in previous_versions, none of them in a rescanned
+        directory, keeps its previous versions without reading its files. So a file
+        edited in place, which leaves its directory unchanged, is not compared again.
+        """
+        previous_versions = previous_versions or {}
+        rescanned = rescanned or set()
+        result = {}
+        ambiguous_map = {}
+        for key, paths in file_map.items():
+            if len(paths) < 2:
+                continue
+            previous = previous_versions.get(key)
+            if (previous is not None
+                    and sorted(path for version in previous for path in version) == paths
+                    and not any(os.path.dirname(path) in rescanned for path in paths)):
+                result[key] = previous
+            else:
+                ambiguous_map[key] = paths
+        if self.verbose and previous_versions:
+            print(f"Comparing the contents of {len(ambiguous_map)} of {len(ambiguous_map) + len(result)} groups")
+        result.update(ContentClassifier(self.max_workers).classify(ambiguous_map))
+        return result
+
+    def read_file_list(self, list_file: FileName):
+        """ Group the paths of a 'find -type f' listing by basename, instead of walking a tree.
+
+        The listing is streamed a line at a time; "-" reads standard input and a name
+        ending in ".gz" is decompressed on the fly.
+        """
+        if list_file == "-":
+            f = sys.stdin
+        elif list_file.endswith(".gz"):
+            f = gzip.open(list_file, "rt", encoding="latin-1")
+        else:
+            f = open(list_file, "r", encoding="latin-1")
+        base_map = self.base_map
+        pattern = self.pattern
+        try:
+            for line in f:
+                path = line.rstrip("\n")
+                basename = path[path.rfind('/') + 1:]
+                if not pattern.match(basename):
+                    continue
+                paths = base_map.get(basename)
+                if paths is None:
+                    base_map[basename] = [path]
+                else:
+                    paths.append(path)
+        finally:
+            if f is not sys.stdin:
+                f.close()
         pass
 
+    def write_text_group(self, f, number: int, key: str, paths: List[FileName],
+                         key_versions: List[List[FileName]]):
+        num_dirs = len(paths)
+        if key_versions is None:
+            f.write(f"#{number}:{key} is found in {num_dirs} directories\n")
+            for i in range(num_dirs):
+                f.write(f"    [{i}]={paths[i]}\n")
+            return
+        if len(key_versions) == 1:
+            kind = "identical copies"
+        else:
+            kind = f"divergent versions ({len(key_versions)} distinct)"
+        f.write(f"#{number}:{key} is found in {num_dirs} directories: {kind}\n")
+        version_of = {path: v for v, version_paths in enumerate(key_versions) for path in version_paths}
+        for i in range(num_dirs):
+            f.write(f"    [{i}]={paths[i]} version {version_of[paths[i]]}\n")
+
+    def write_json_group(self, f, number: int, key: str, paths: List[FileName],
+                         key_versions: List[List[FileName]], status: str = None):
+        record = {"name": key, "paths": paths}
+        if status is not None:
+            record["status"] = status
+        if key_versions is not None:
+            record["identical"] = len(key_versions) == 1
+            record["versions"] = key_versions
+        f.write(json.dumps(record))
+        f.write("\n")
+
+    def write_delta(self, f, file_map: Dict[str, List[FileName]], versions):
+        """ Write the ambiguities that appeared, disappeared or changed since the previous run. """
+        previous = self.previous_ambiguous
+        counts = {"new": 0, "changed": 0, "resolved": 0}
+        num_ambiguous = 0
+        for key, value in file_map.items():
+            if len(value) < 2:
+                continue
+            num_ambiguous += 1
+            if key not in previous:
+                status = "new"
+            elif previous[key] != value:
+                status = "changed"
+            else:
+                continue
+            counts[status] += 1
+            if self.output_format == "jsonl":
+                self.write_json_group(f, num_ambiguous, key, value, versions.get(key), status)
+            else:
+                f.write(f"{status.capitalize()} ambiguity:\n")
+                self.write_text_group(f, num_ambiguous, key, value, versions.get(key))
+        for key in sorted(previous):
+            if len(file_map.get(key, [])) < 2:
+                counts["resolved"] += 1
+                if self.output_format == "jsonl":
+                    self.write_json_group(f, 0, key, file_map.get(key, []), None, "resolved")
+                else:
+                    f.write(f"Resolved ambiguity: {key} was found in {len(previous[key])} directories\n")
+        if self.output_format != "jsonl":
+            f.write(f"Total ambiguous = {num_ambiguous} (new = {counts['new']}, "
+                    f"changed = {counts['changed']}, resolved = {counts['resolved']})\n")
+
     def find_ambiguities(self):
         """ Look for ambiguities in the file_list"""
-        file_map = {}
-        for line in self.file_list:
-            line = line.strip("\n")
-            basename = os.path.basename(line)
-            if basename in file_map:
-                dirs = file_map[basename]
-                dirs.append(line)
-            else:
-                file_map[basename] = [line]
+        if self.base_map:
+            # find_files or read_file_list already grouped the files by basename.
+            file_map = self.base_map
+        else:
+            file_map = {}
+            for line in self.file_list:
+                line = line.strip("\n")
+                basename = os.path.basename(line)
+                if basename in file_map:
+                    dirs = file_map[basename]
+                    dirs.append(line)
+                else:
+                    file_map[basename] = [line]
         num_ambiguous = 0
         if self.out_file == "-":
             f = sys.stdout
         else:
             f = open(self.out_file, "w")
 
-        for key, value in file_map.items():
-            num_dirs = len(value)
-            if num_dirs > 1:
-                num_ambiguous += 1
-                f.write(f"#{num_ambiguous}:{key} is found in {num_dirs} directories\n")
-                for i in range(num_dirs):
-                    f.write(f"    [{i}]={value[i]}\n")
-        f.write(f"Total ambiguous = {num_ambiguous}\n")
+        if self.compare_content and self.versions is None:
+            self.versions = self.get_versions(file_map)
+        versions = self.versions or {}
+
+        if self.output_format == "jsonl":
+            write_group = self.write_json_group
+        else:
+            write_group = self.write_text_group
+        try:
+            if self.previous_ambiguous is not None:
+                self.write_delta(f, file_map, versions)
+                return
+            for key, value in file_map.items():
+                if len(value) > 1:
+                    num_ambiguous += 1
+                    write_group(f, num_ambiguous, key, value, versions.get(key))
+            if self.output_format != "jsonl":
+                f.write(f"Total ambiguous = {num_ambiguous}\n")
+        finally:
+            if f is sys.stdout:
+                f.flush()
+            else:
+                f.close()
+
+def usage():
+    """ Usage:
+    python3 find-ambiguous.py [options] <pattern> <directory> (<outputfile>|-)
+    python3 find-ambiguous.py [options] --input-list <listfile> <pattern> (<outputfile>|-)
+    python3 find-ambiguous.py [options] --snapshot <file> <pattern> <directory> (<outputfile>|-)
+
+    Report files whose names match the regular expression <pattern> and
+    that occur in more than one directory under <directory>, or in more than
+    one directory of <listfile>, the output of 'find -type f' (use - for
+    standard input; a name ending in .gz is read compressed).
+
+    Options:
+      --follow-symlinks   Descend into symbolic links to directories
+      --exclude <glob>    Do not enter directories whose name matches <glob>
+                          (may be repeated)
+      --jobs <n>          Number of directory walking (and hashing) threads
+      --format jsonl      Write one JSON object per ambiguous name instead of
+                          the text report
+      --snapshot <file>   Keep a snapshot of the tree in <file>. Later runs
+                          only list directories whose mtime changed and report
+                          the ambiguities that are new, changed or resolved
+      --compare-content   Say whether each ambiguous file's copies are identical
+                          or divergent, and which copies share a version. With
+                          --snapshot, only files in listed directories are
+                          compared again
+    """
+    print(usage.__doc__)
+    sys.exit(1)
+
 
 if __name__ == u'__main__':
-    print('Finding ambiguous files\n')
-    if len(sys.argv) != 4:
-        print("Usage: find-ambiguous.py <pattern> <directory> (<outputfile>|-)")
-        exit(1)
-
-    pattern = sys.argv[1]
-    root_dir = sys.argv[2]
-    out_file = sys.argv[3]
-    finder = AmbiguousFinder(pattern, root_dir, out_file)
-    finder.find_files()
+    args = sys.argv[1:]
+    follow_symlinks = False
+    exclude_globs = []
+    max_workers = None
+    compare_content = False
+    list_file = None
+    snapshot_file = None
+    output_format = "text"
+    while len(args) > 0 and args[0].startswith('--'):
+        option = args.pop(0)
+        if option == '--follow-symlinks':
+            follow_symlinks = True
+        elif option == '--exclude' and len(args) > 0:
+            exclude_globs.append(args.pop(0))
+        elif option == '--jobs' and len(args) > 0:
+            max_workers = int(args.pop(0))
+        elif option == '--compare-content':
+            compare_content = True
+        elif option == '--snapshot' and len(args) > 0:
+            snapshot_file = args.pop(0)
+        elif option == '--input-list' and len(args) > 0:
+            list_file = args.pop(0)
+        elif option == '--format' and len(args) > 0 and args[0] in ("text", "jsonl"):
+            output_format = args.pop(0)
+        else:
+            usage()
+    if list_file is None and len(args) == 3:
+        pattern, root_dir, out_file = args
+    elif list_file is not None and snapshot_file is None and len(args) == 2:
+        pattern, out_file = args
+        root_dir = ""
+    else:
+        usage()
+
+    finder = AmbiguousFinder(pattern, root_dir, out_file, follow_symlinks, exclude_globs, max_workers,
+                             compare_content, output_format)
+    if finder.verbose:
+        print('Finding ambiguous files\n')
+    if snapshot_file is not None:
+        finder.find_files_with_snapshot(snapshot_file)
+    elif list_file is None:
+        finder.find_files()
+    else:
+        finder.read_file_list(list_file)
     finder.find_ambiguities()
-    print('\ndone.\n')
+    if finder.verbose:
+        print('\ndone.\n')
@@ -2,15 +2,24 @@
 This module reads a Polyspace options file (that was generated by watching a build)
 and generates an Astree configuration dax fragment.
 """
+import hashlib
+import io
 import os
 import re
+import stat
 import sys
-from typing import Dict, List, Set, FrozenSet
-from collections import defaultdict
+import tempfile
+from typing import Callable, Dict, Iterable, Iterator, List, Set, FrozenSet, Tuple
+from collections import Counter, defaultdict
+from xml.sax.saxutils import escape, quoteattr
 
 DirectoryName = str
 FileName = str
 
+# The process umask, for the mode of newly written files.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 
 def get_includes(line: str) -> Set[str]:
     """ Return the set of Include options from the -options-for-sources line. """
@@ -22,107 +31,154 @@ def get_includes(line: str) -> Set[str]:
 
 
 def partition_parts(part_dict: Dict[str, List[str]]) -> List[Set[str]]:
-    part_keys = list(part_dict)
-    num_keys = len(part_keys)
-    assert (num_keys > 0)
-    first_key = part_keys[0]
-    first_list = part_dict[first_key]
-    first_set = set(first_list)
-    partition = [first_set]
-    all_parts = set()
-    for i in range(1, num_keys):
-        for pi in partition:
-            if len(pi) == 0:
-                assert (False)
-        parts = set(part_dict[part_keys[i]])
-        all_parts.update(parts)
-        new_partition = []
-        for pi in partition:
-            if len(parts) == 0:
-                new_partition.append(pi)
-            elif parts.isdisjoint(pi):
-                new_partition.append(pi)
-            elif parts == pi:
-                new_partition.append(pi)
-                parts = set()
+    """
+    Return the coarsest partition of all the parts such that each list in part_dict
+    is a union of blocks, largest blocks first.
+
+    Each list only refines the blocks its own parts are in, found through a
+    part-to-block map, so the work is linear in the total number of parts.
+    """
+    assert (len(part_dict) > 0)
+    blocks: List[Set[str]] = []
+    block_of: Dict[str, int] = {}
+    # The blocks are kept in a doubly linked chain so that blocks of equal size keep a
+    # stable order: the parts split off a block go just before the rest of it, and new
+    # blocks go last.
+    prev_block: List[int] = []
+    next_block: List[int] = []
+    first = -1
+    last = -1
+    for part_list in part_dict.values():
+        touched: Dict[int, List[str]] = defaultdict(list)
+        new_parts = []
+        for part in set(part_list):
+            block = block_of.get(part)
+            if block is None:
+                new_parts.append(part)
             else:
-                inter = parts.intersection(pi)
-                dif = pi.difference(parts)
-                parts = parts.difference(pi)
-                new_partition.append(inter)
-                if len(dif) > 0:
-                    new_partition.append(dif)
-                pass
-            pass
-        if len(parts) > 0:
-            new_partition.append(parts)
-        partition = new_partition
+                touched[block].append(part)
+        for block, inter in touched.items():
+            if len(inter) == len(blocks[block]):
+                continue
+            split = len(blocks)
+            blocks[block].difference_update(inter)
+            blocks.append(set(inter))
+            for part in inter:
+                block_of[part] = split
+            prev = prev_block[block]
+            prev_block.append(prev)
+            next_block.append(block)
+            prev_block[block] = split
+            if prev < 0:
+                first = split
+            else:
+                next_block[prev] = split
+        if new_parts:
+            block = len(blocks)
+            blocks.append(set(new_parts))
+            for part in new_parts:
+                block_of[part] = block
+            prev_block.append(last)
+            next_block.append(-1)
+            if last < 0:
+                first = block
+            else:
+                next_block[last] = block
+            last = block
         pass
-    pass
+    partition = []
+    block = first
+    while block >= 0:
+        partition.append(blocks[block])
+        block = next_block[block]
     partition = sorted(partition, key=len, reverse=True)
-    partition_all = set();
-    for pi in partition:
-        partition_all.update(pi)
-    assert (all_parts == partition_all)
-    for i in range(len(partition)):
-        for k in range(i + 1, len(partition)):
-            assert (partition[i].isdisjoint(partition[k]))
+    # Every part is in exactly one block.
+    assert (sum(len(pi) for pi in partition) == len(block_of))
     return partition
 
 
-def get_file_partition_indices(part_dict: Dict[FileName, List[str]], partition) -> Dict[FileName, List[int]]:
-    result = {}
-    for file in part_dict:
-        parts = part_dict[file]
-        part_set = set(parts)
-        file_result = []
-        result[file] = file_result
-        for i in range(len(partition)):
-            parti = partition[i]
-            if parti <= part_set:
-                file_result.append(i)
-        pass
-    return result
-
-
-def get_index_groups(file_indices: Dict[FileName, List[int]]) -> Dict[FrozenSet[int], List[FileName]]:
+def get_signature_groups(part_dict: Dict[FileName, List[str]], partition: List[Set[str]]) \
+        -> Tuple[List[FrozenSet[int]], Dict[int, List[FileName]], Dict[FileName, int],
+                 Dict[int, Set[DirectoryName]], Dict[DirectoryName, List[int]]]:
     """
-    The range of file_indices is a list of indices into the partition of options/definitions, etc.
-    Call these option partition groups.
+    Group the files by the set of indices of the partition blocks their parts are in.
+    Call these option partition groups. Every part list is a union of blocks, so the
+    blocks a file's parts are in are the blocks it contains.
 
     Results returned:
 
     group_list - a list of frozen groups, sorted by descending frequency of use.
-
+    group_index_to_files - the files of each group, by index into group_list.
+    file_group - the group index of each file.
+    group_index_to_dirs - the directories of the files of each group.
+    dir_groups - the group indices of each directory, with the directories in file order.
     """
-
-    #
-    group_to_file_list_dict: Dict[FrozenSet[int], List[FileName]] = {}
-    for file in list(file_indices):
-        indices = frozenset(file_indices[file])
-        if indices in group_to_file_list_dict:
-            group_to_file_list_dict[indices].append(file)
-        else:
-            group_to_file_list_dict[indices] = [file]
-    group_list = sorted(list(group_to_file_list_dict), key=lambda fset: len(group_to_file_list_dict[fset]),
-                        reverse=True);
-    group_indices = dict([[group_list[i], i] for i in range(len(group_list))])
-    group_index_to_files = dict([[group_indices[fset], group_to_file_list_dict[fset]] for fset in group_list])
-    file_group = dict([[file, group_indices[frozenset(file_indices[file])]] for file in list(file_indices)])
-    group_index_to_dirs = dict(
-        [[fset_index, set([os.path.dirname(file) for file in group_index_to_files[fset_index]])] for fset_index in
-         group_index_to_files])
+    block_of: Dict[str, int] = {}
+    for i, pi in enumerate(partition):
+        for part in pi:
+            block_of[part] = i
+    group_to_file_list_dict: Dict[FrozenSet[int], List[FileName]] = defaultdict(list)
+    file_signature: Dict[FileName, FrozenSet[int]] = {}
+    for file, parts in part_dict.items():
+        signature = frozenset([block_of[part] for part in parts])
+        file_signature[file] = signature
+        group_to_file_list_dict[signature].append(file)
+    group_list = sorted(group_to_file_list_dict, key=lambda fset: len(group_to_file_list_dict[fset]), reverse=True)
+    group_indices = {fset: i for i, fset in enumerate(group_list)}
+    group_index_to_files = {i: group_to_file_list_dict[fset] for i, fset in enumerate(group_list)}
+    file_group = {file: group_indices[signature] for file, signature in file_signature.items()}
+    group_index_to_dirs = {i: set([os.path.dirname(file) for file in files]) for i, files in group_index_to_files.items()}
     # Get which group indices a directory is in. We fill in with empty lists so the
     # dictionary will be in alphabetical order (because the files are).
-    dir_groups: Dict[DirectoryName, List[int]] = dict([[os.path.dirname(file), []] for file in list(file_indices)])
-
-    for fset_index in list(group_index_to_dirs):
-        dirs = group_index_to_dirs[fset_index]
+    dir_groups: Dict[DirectoryName, List[int]] = {os.path.dirname(file): [] for file in part_dict}
+    for fset_index, dirs in group_index_to_dirs.items():
         for dir in dirs:
             dir_groups[dir].append(fset_index)
     return (group_list, group_index_to_files, file_group, group_index_to_dirs, dir_groups)
 
 
+def get_content_hash(filename: FileName) -> bytes:
+    """ Return the digest of the file's content, or b'' if it cannot be read. """
+    try:
+        with open(filename, "rb") as f:
+            return hashlib.blake2b(f.read()).digest()
+    except OSError:
+        return b''
+
+
+def make_temp_file(filename: FileName) -> Tuple[int, FileName]:
+    """
+    Create a temporary file next to filename, so it can be renamed over it, with the
+    mode of the existing file or, failing that, the default mode for a new file.
+    """
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                         prefix='.' + os.path.basename(filename) + '.')
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+    os.chmod(temp_filename, mode)
+    return fd, temp_filename
+
+
+def write_if_changed(filename: FileName, content: bytes) -> bool:
+    """
+    Replace filename with content, atomically, unless it already has that content.
+    Return True if the file was written.
+    """
+    if get_content_hash(filename) == hashlib.blake2b(content).digest():
+        return False
+    fd, temp_filename = make_temp_file(filename)
+    try:
+        with os.fdopen(fd, "wb") as w:
+            w.write(content)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+    return True
+
+
 def strip_leading(arg: str, leading: str):
     if arg.startswith(leading):
         return "./" + arg[len(leading):]
@@ -130,28 +186,147 @@ def strip_leading(arg: str, leading: str):
         return arg
 
 
+class DaxWriter:
+    """
+    Writer of indented DAX XML that escapes every text and attribute value.
+
+    Lines are collected and written out in chunks of about buffer_size characters,
+    rather than with one write per line.
+    """
+
+    def __init__(self, w, indent: str = "    ", buffer_size: int = 1 << 16):
+        self.w = w
+        # Amount to indent xml per level
+        self.indent = indent
+        self.level = 0
+        self.buffer_size = buffer_size
+        self.buffer: List[str] = []
+        self.buffered = 0
+
+    def addline(self, line: str):
+        """ Add a line of markup, which is not escaped, at the current level. """
+        line = self.indent * self.level + line + "\n"
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.w.write("".join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def start(self, tag: str, attributes: Dict[str, str] = None):
+        """ Open an element, with attributes, and indent its content. """
+        attribute_text = ''
+        if attributes:
+            attribute_text = ''.join([f" {key}={quoteattr(val)}" for key, val in attributes.items()])
+        self.addline(f"<{tag}{attribute_text}>")
+        self.level += 1
+
+    def end(self, tag: str):
+        self.level -= 1
+        self.addline(f"</{tag}>")
+
+    def element(self, tag: str, text: str):
+        """ Write an element containing only text. """
+        self.addline(f"<{tag}>{escape(text)}</{tag}>")
+
+    def element_list(self, tag: str, texts: Iterable[str]):
+        """ Write an element containing a text element for each of texts, tagged without the final 's'. """
+        element_tag = tag[:-1]
+        self.start(tag)
+        for text in texts:
+            self.element(element_tag, text)
+        self.end(tag)
+
+
+class HoistNode:
+    """ Shared Astree config holding the includes and defines common to the configs under it. """
+    __slots__ = ('blocks', 'includes', 'defines', 'children', 'groups')
+
+    def __init__(self):
+        # Partition block indices whose defines are hoisted into this config.
+        self.blocks: FrozenSet[int] = frozenset()
+        # The hoisted "-I " options, in search order, and "-D " options.
+        self.includes: List[str] = []
+        self.defines: List[str] = []
+        self.children: List['HoistNode'] = []
+        # Groups whose configs are directly in this config.
+        self.groups: List[int] = []
+
+
+class PathPrefixNode:
+    """ Node of a PathPrefixMap. """
+    __slots__ = ('children', 'replacement')
+
+    def __init__(self):
+        self.children: Dict[str, 'PathPrefixNode'] = {}
+        # Replacement for the directory prefix ending at this node, if it is one.
+        self.replacement = None
+
+
+class PathPrefixMap:
+    """
+    Map of directory prefixes, each ending with '/', to their replacements.
+
+    The prefixes are stored in a trie keyed on their path components, so the longest
+    prefix of a path is found in one walk over the path's leading directories,
+    however many prefixes there are.
+    """
+
+    def __init__(self):
+        self.root = PathPrefixNode()
+
+    def add(self, prefix: DirectoryName, replacement: str):
+        assert (prefix.endswith('/'))
+        node = self.root
+        for component in prefix[:-1].split('/'):
+            child = node.children.get(component)
+            if child is None:
+                child = PathPrefixNode()
+                node.children[component] = child
+            node = child
+        node.replacement = replacement
+
+    def replace(self, path: str) -> str:
+        """ Replace the longest prefix of path that is in the map, if any. """
+        node = self.root
+        replacement = None
+        prefix_length = 0
+        start = 0
+        slash = path.find('/')
+        while slash >= 0:
+            node = node.children.get(path[start:slash])
+            if node is None:
+                break
+            start = slash + 1
+            if node.replacement is not None:
+                replacement = node.replacement
+                prefix_length = start
+            slash = path.find('/', start)
+        if replacement is None:
+            return path
+        return replacement + path[prefix_length:]
+
+
 class AstreeConfigure:
     """ Digest .depend files"""
 
     def adjust_src(self, arg: str):
-        for old in list(self.adjust_dict):
-            if arg.startswith(old):
-                return self.adjust_dict[old] + arg[len(old):]
-        return arg
+        return self.adjust_map.replace(arg)
 
     def old_to_new(self, arg: str):
-        for old in list(self.old_to_new_dict):
-            if arg.startswith(old):
-                return self.old_to_new_dict[old] + arg[len(old):]
-            elif arg.startswith('"' + old):
-                return '"' + self.old_to_new_dict[old] + arg[len(old)+1:]
-        return arg
+        if arg.startswith('"'):
+            return '"' + self.old_to_new_map.replace(arg[1:])
+        return self.old_to_new_map.replace(arg)
 
     def expand_symbolic_src(self, arg: str):
-        for symbolic_ref in list(self.symbol_dict):
-            if arg.startswith(symbolic_ref):
-                result = self.symbol_dict[symbolic_ref] + arg[len(symbolic_ref):]
-                return result
+        # A symbolic reference ends at its '}', so it is found with one lookup.
+        if arg.startswith('${'):
+            symbolic_ref = arg[:arg.find('}') + 1]
+            if symbolic_ref in self.symbol_dict:
+                return self.symbol_dict[symbolic_ref] + arg[len(symbolic_ref):]
         return arg
 
     def strip_inc(self, arg: str):
@@ -230,17 +405,17 @@ class AstreeConfigure:
         self.indent = "    "
         self.input_filename = input_filename
         self.output_filename = output_filename
-        self.adjust_dict = {}
         self.symbol_dict = {}
-        self.old_to_new_dict = {}
+        self.adjust_map = PathPrefixMap()
+        self.old_to_new_map = PathPrefixMap()
         for i, triple in enumerate(triples):
             old, symbol, new = triple.split(';')
             old = self.normalize_dir(old)
             new = self.normalize_dir(new)
             symbol_ref = '${' + symbol + "}"
-            self.adjust_dict[old] = symbol_ref + '/'
             self.symbol_dict[symbol_ref] = new[:-1]
-            self.old_to_new_dict[old] = new
+            self.adjust_map.add(old, symbol_ref + '/')
+            self.old_to_new_map.add(old, new)
 
         self.lines = self.read_input
         # Collect the -options-for-sources lines.
@@ -255,9 +430,20 @@ class AstreeConfigure:
         self.vocabulary = self.get_vocabulary()
         # self.filter_vocabulary()
         self.partition = partition_parts(self.ofs_dict)
-        self.indices_dict = get_file_partition_indices(self.ofs_dict, self.partition)
         self.group_list, self.group_index_to_files, self.file_group, self.group_index_to_dirs, self.dir_groups = \
-            get_index_groups(self.indices_dict)
+            get_signature_groups(self.ofs_dict, self.partition)
+        # Sizes and per-group data used to decide what to hoist, set up by output_hoisted_configs.
+        self.prop_bytes: Dict[str, int] = {}
+        self.block_bytes: List[int] = []
+        self.hoist_signatures: List[FrozenSet[int]] = []
+        self.group_includes: List[List[str]] = []
+        self.group_config_counts: List[int] = []
+        self.group_config_lines: List[int] = []
+        # (bytes, lines) of the tags of a shared config and of its includes and defines lists.
+        self.shared_config_tag_size = (0, 0)
+        self.list_tag_sizes: Dict[str, Tuple[int, int]] = {}
+        # Number of shared configs written so far, for their names.
+        self.shared_config_count = 0
 
         # common_includes = get_includes(self.ofs_lines[0])
         # common_usr_includes = get_usr_includes(self.ofs_lines[0])
@@ -312,43 +498,30 @@ class AstreeConfigure:
             result.update(part_set)
         return result
 
-    def get_includes_for_group(self, libname: str, group: int):
-        group_properties: Set[str] = self.get_group_properties(group)
-
-        # For includes, the order may be important. Use the order of the
-        # first file for this group.
-        first_file = self.group_index_to_files[group][0]
-        file_props: List[str] = self.ofs_dict[first_file]
-        include_list = []
-        for prop in file_props:
-            assert (prop in group_properties)
-            if prop.startswith('-I '):
-                include_list.append(self.expand_symbolic_src(prop[3:]))
-
-        return include_list
+    def get_includes_for_props(self, props: List[str]) -> List[str]:
+        return [self.expand_symbolic_src(prop[3:]) for prop in props if prop.startswith('-I ')]
 
-    def get_defines_for_group(self, libname: str, group: int):
-        group_properties: Set[str] = self.get_group_properties(group)
+    def get_define_value(self, prop: str) -> str:
+        """ Return the define of a "-D " option, with a path value mapped to the new tree. """
+        old_def = prop[3:]
+        def_parts = old_def.split("=")
+        if len(def_parts) == 2:
+            new_rhs = self.old_to_new(def_parts[1])
+            def_parts[1] = new_rhs
+            old_def = "=".join(def_parts)
+        return old_def
 
-        # For defines, the order is not important, but use the order of the
-        # first file for this group anyway.
-        first_file = self.group_index_to_files[group][0]
-        file_props: List[str] = self.ofs_dict[first_file]
+    def get_defines_for_props(self, props: List[str]) -> List[str]:
         define_set = set()
-        for prop in file_props:
-            assert (prop in group_properties)
+        for prop in props:
             if prop.startswith('-D '):
-                old_def = prop[3:]
-                def_parts = old_def.split("=")
-                if len(def_parts) == 2:
-                    new_rhs = self.old_to_new(def_parts[1])
-                    def_parts[1] = new_rhs
-                    old_def = "=".join(def_parts)
-                define_set.add(old_def)
+                define_set.add(self.get_define_value(prop))
 
         define_list = list(define_set)
         define_list = sorted(define_list)
+        return define_list
 
+    def check_duplicate_defines(self, define_list: List[str]):
         # For defines with value, check no duplicates.
         dup_dict = {}
         for define in define_list:
@@ -361,6 +534,32 @@ class AstreeConfigure:
                 else:
                     dup_dict[lhs] = parts[1]
 
+    def get_includes_for_group(self, libname: str, group: int, hoisted_count: int = 0):
+        group_properties: Set[str] = self.get_group_properties(group)
+
+        # For includes, the order may be important. Use the order of the
+        # first file for this group. Leave out the first hoisted_count, which
+        # were hoisted into the parent configs.
+        first_file = self.group_index_to_files[group][0]
+        file_props: List[str] = self.ofs_dict[first_file]
+        for prop in file_props:
+            assert (prop in group_properties)
+        return self.get_includes_for_props(file_props)[hoisted_count:]
+
+    def get_defines_for_group(self, libname: str, group: int, hoisted: Set[str] = frozenset()):
+        group_properties: Set[str] = self.get_group_properties(group)
+
+        # For defines, the order is not important, but use the order of the
+        # first file for this group anyway. Leave out those hoisted into the parent configs.
+        first_file = self.group_index_to_files[group][0]
+        file_props: List[str] = self.ofs_dict[first_file]
+        for prop in file_props:
+            assert (prop in group_properties)
+        define_list = self.get_defines_for_props(file_props)
+        # Check the config's effective defines, including those hoisted into its parents.
+        self.check_duplicate_defines(define_list)
+        if hoisted:
+            define_list = self.get_defines_for_props([prop for prop in file_props if prop not in hoisted])
         return define_list
 
     def get_options_for_group(self, libname: str, group: int):
@@ -381,7 +580,8 @@ class AstreeConfigure:
 
         return option_list
 
-    def get_config_for_group_and_dir(self, the_dir: DirectoryName, group: int):
+    def get_config_for_group_and_dir(self, the_dir: DirectoryName, group: int,
+                                     hoisted_includes: int = 0, hoisted_defines: Set[str] = frozenset()):
         config = {}
         # Use the first source file for the name of the library.
         group_dir_file_list = [file for file in self.group_index_to_files[group] if os.path.dirname(file) == the_dir]
@@ -421,9 +621,9 @@ class AstreeConfigure:
 
         config['files'] = files
 
-        includes = self.get_includes_for_group(libname, group)
+        includes = self.get_includes_for_group(libname, group, hoisted_includes)
         config['includes'] = includes
-        defines = self.get_defines_for_group(libname, group)
+        defines = self.get_defines_for_group(libname, group, hoisted_defines)
         config['defines'] = defines
         options = self.get_options_for_group(libname, group)
         if len(options) > 0:
@@ -432,65 +632,218 @@ class AstreeConfigure:
         # Astree does not have compiler options in configurations
         return config
 
-    def output_single(self, config, key: str, val: str):
-        self.addline(f"<{key}>{val}</{key}>")
+    def output_config(self, dax: DaxWriter, config, omit_empty: bool = False):
+        dax.start('config', {'name': config['name']})
+        dax.element('base', config['base'])
+        dax.element('language', config['language'])
+        dax.element_list('files', config['files'])
+        for key in ['includes', 'defines']:
+            if config[key] or not omit_empty:
+                dax.element_list(key, config[key])
+        dax.end('config')
         pass
 
-    def output_list(self, config, key: str):
-        ekey = key[:-1]
-        self.addline(f"<{key}>")
-        self.level += 1
-        for elem in config[key]:
-            self.output_single(config, ekey, elem)
-        self.level -= 1
-        self.addline(f"</{key}>")
-        pass
-
-    def output_config(self, config):
-        self.addline(f"<config name=\"{config['name']}\">")
-        self.level += 1
-        self.output_single(config, 'base', config['base'])
-        self.output_single(config, 'language', config['language'])
-        self.output_list(config, 'files')
-        self.output_list(config, 'includes')
-        self.output_list(config, 'defines')
-        self.level -= 1
-        self.addline(f"</config>")
-        pass
-
-    def addline(self, line):
-        self.w.write(self.indent * self.level)
-        self.w.write(line)
-        self.w.write("\n")
-
-    def output_astree_config(self):
-        configs = []
+    def iter_configs(self) -> Iterator[Dict]:
+        """ Yield the config of each group of each directory as it is computed. """
         for the_dir in list(self.dir_groups):
             for group in self.dir_groups[the_dir]:
-                config = self.get_config_for_group_and_dir(the_dir, group)
-                configs.append(config)
+                yield self.get_config_for_group_and_dir(the_dir, group)
+
+    @staticmethod
+    def get_rendered_size(write: Callable[[DaxWriter], None]) -> Tuple[int, int]:
+        """ Return the bytes and lines, without indentation, that write renders with a DaxWriter. """
+        w = io.StringIO()
+        dax = DaxWriter(w, "")
+        write(dax)
+        dax.flush()
+        text = w.getvalue()
+        return len(text.encode("utf-8")), text.count("\n")
+
+    def get_prop_bytes(self, prop: str) -> int:
+        """ Return the bytes, without indentation, of the element an include or define option is written as. """
+        if prop.startswith('-I '):
+            return self.get_rendered_size(lambda dax: dax.element('include', self.expand_symbolic_src(prop[3:])))[0]
+        if prop.startswith('-D '):
+            return self.get_rendered_size(lambda dax: dax.element('define', self.get_define_value(prop)))[0]
+        return 0
+
+    def write_shared_config_tags(self, dax: DaxWriter):
+        """ Write the tags of an empty shared config, named as the last one could be. """
+        dax.start('config', {'name': f"SharedConfig{len(self.group_list)}"})
+        dax.end('config')
+
+    def make_hoist_node(self, groups: List[int], hoisted_blocks: FrozenSet[int], hoisted_includes: int) -> HoistNode:
+        """
+        Return a node for groups, without children, given what is already hoisted into
+        the enclosing configs.
+
+        The defines of the blocks used by all of groups are hoisted into the node. Its
+        includes are the longest run that comes next in every group's include order,
+        so the search order of each config is kept.
+        """
+        node = HoistNode()
+        node.groups = groups
+        node.blocks = frozenset.intersection(*[self.hoist_signatures[group] for group in groups]) - hoisted_blocks
+        node.defines = sorted([prop for block in node.blocks for prop in self.partition[block]
+                               if prop.startswith('-D ')])
+        first_includes = self.group_includes[groups[0]]
+        end = hoisted_includes
+        while end < len(first_includes) and all([end < len(self.group_includes[group])
+                                                 and self.group_includes[group][end] == first_includes[end]
+                                                 for group in groups]):
+            end += 1
+        node.includes = first_includes[hoisted_includes:end]
+        return node
+
+    def get_hoist_saving(self, node: HoistNode, level: int) -> int:
+        """
+        Return the bytes saved by writing node as a shared config at level rather than
+        leaving its configs where they are. A shared config costs its tags and one more
+        indentation on every line of the configs inside it.
+        """
+        configs = sum([self.group_config_counts[group] for group in node.groups])
+        hoisted_bytes = sum([self.prop_bytes[prop] for prop in node.includes + node.defines])
+        inner_lines = sum([self.group_config_lines[group] for group in node.groups])
+        tag_bytes, tag_lines = self.shared_config_tag_size
+        for key, props in [('includes', node.includes), ('defines', node.defines)]:
+            if props:
+                tag_bytes += self.list_tag_sizes[key][0]
+                tag_lines += self.list_tag_sizes[key][1]
+        cost = tag_bytes + len(self.indent) * (level + 1) * tag_lines + len(self.indent) * inner_lines
+        return (configs - 1) * hoisted_bytes - cost
+
+    def add_hoist_children(self, node: HoistNode, hoisted_blocks: FrozenSet[int], hoisted_includes: int,
+                           level: int):
+        """
+        Move groups of node into shared child configs while that saves bytes.
 
-        with open(self.output_filename, "w") as w:
-            self.w = w
-            self.level = 0
-            self.addline("""<?xml version="1.0" encoding="utf-8"?>
+        Candidates are the groups using a block not yet hoisted, taking the blocks
+        that could save the most first. A candidate whose shared config would not
+        save bytes is dropped and its groups stay in node.
+        """
+        hoisted_blocks = hoisted_blocks | node.blocks
+        hoisted_includes += len(node.includes)
+        signatures = {group: self.hoist_signatures[group] - hoisted_blocks for group in node.groups}
+        # Number of configs using each block not yet hoisted.
+        counts = Counter()
+        for group in node.groups:
+            for block in signatures[group]:
+                counts[block] += self.group_config_counts[group]
+        remaining = node.groups
+        while counts:
+            # Break ties by block index so the tree is deterministic.
+            block, estimate = max([(block, (count - 1) * self.block_bytes[block]) for block, count in counts.items()],
+                                  key=lambda item: (item[1], -item[0]))
+            if estimate <= 0:
+                break
+            del counts[block]
+            sharing = [group for group in remaining if block in signatures[group]]
+            child = self.make_hoist_node(sharing, hoisted_blocks, hoisted_includes)
+            if self.get_hoist_saving(child, level) <= 0:
+                continue
+            remaining = [group for group in remaining if block not in signatures[group]]
+            for group in sharing:
+                for other_block in signatures[group]:
+                    counts[other_block] -= self.group_config_counts[group]
+            counts = +counts
+            self.add_hoist_children(child, hoisted_blocks, hoisted_includes, level + 1)
+            node.children.append(child)
+        node.groups = remaining
+
+    def output_hoisted_includes_and_defines(self, dax: DaxWriter, node: HoistNode):
+        includes = self.get_includes_for_props(node.includes)
+        if includes:
+            dax.element_list('includes', includes)
+        defines = self.get_defines_for_props(node.defines)
+        if defines:
+            dax.element_list('defines', defines)
+
+    def output_hoist_node(self, dax: DaxWriter, node: HoistNode, hoisted_includes: int, hoisted_defines: Set[str]):
+        """ Write the shared configs of the children of node, and the configs of its groups. """
+        for child in node.children:
+            self.shared_config_count += 1
+            dax.start('config', {'name': f"SharedConfig{self.shared_config_count}"})
+            self.output_hoisted_includes_and_defines(dax, child)
+            self.output_hoist_node(dax, child, hoisted_includes + len(child.includes),
+                                   hoisted_defines | set(child.defines))
+            dax.end('config')
+        for group in node.groups:
+            for the_dir in sorted(self.group_index_to_dirs[group]):
+                config = self.get_config_for_group_and_dir(the_dir, group, hoisted_includes, hoisted_defines)
+                self.output_config(dax, config, omit_empty=True)
+
+    def output_hoisted_configs(self, dax: DaxWriter):
+        """
+        Write the configs nested in shared configs that hold the includes and defines
+        common to the configs under them, where that makes the dax fragment smaller.
+        Those common to all are written in the enclosing config. Only a run of includes
+        that starts every member's remaining include order is hoisted, so each config
+        still sees its includes in the original order.
+        """
+        if not self.group_list:
+            return
+        self.prop_bytes = {prop: self.get_prop_bytes(prop) for prop in self.vocabulary}
+        self.shared_config_tag_size = self.get_rendered_size(self.write_shared_config_tags)
+        self.list_tag_sizes = {key: self.get_rendered_size(lambda dax: dax.element_list(key, []))
+                               for key in ['includes', 'defines']}
+        self.block_bytes = [sum([self.prop_bytes[prop] for prop in self.partition[block]])
+                            for block in range(len(self.partition))]
+        self.hoist_signatures = [frozenset([block for block in group_blocks if self.block_bytes[block] > 0])
+                                 for group_blocks in self.group_list]
+        self.group_includes = []
+        self.group_config_counts = []
+        self.group_config_lines = []
+        for group in range(len(self.group_list)):
+            file_props = self.ofs_dict[self.group_index_to_files[group][0]]
+            self.group_includes.append([prop for prop in file_props if prop.startswith('-I ')])
+            num_defines = len(set([prop for prop in file_props if prop.startswith('-D ')]))
+            num_dirs = len(self.group_index_to_dirs[group])
+            self.group_config_counts.append(num_dirs)
+            # Config, base, language, files, includes and defines lines of every config of the group.
+            self.group_config_lines.append(num_dirs * (10 + len(self.group_includes[group]) + num_defines)
+                                           + len(self.group_index_to_files[group]))
+        root = self.make_hoist_node(list(range(len(self.group_list))), frozenset(), 0)
+        self.add_hoist_children(root, frozenset(), 0, 3)
+        self.output_hoisted_includes_and_defines(dax, root)
+        self.shared_config_count = 0
+        self.output_hoist_node(dax, root, len(root.includes), set(root.defines))
+
+    def output_astree_config(self, hoist: bool = False) -> bool:
+        """
+        Render the dax fragment in memory and write it to the output file, atomically,
+        if its content changed. Return True if the output file was replaced.
+
+        :param hoist: If True, move includes and defines shared by several configs into
+        enclosing shared configs, leaving each config only its residual.
+        """
+        w = io.StringIO()
+        dax = DaxWriter(w, self.indent)
+        dax.addline("""<?xml version="1.0" encoding="utf-8"?>
 <dax mode="astree" comment-mode="AAL" version="1.9" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:noNamespaceSchemaLocation="http://www.absint.com/dtd/a3-dax-20.04.xsd" xmlns="http://www.absint.com/dax">
     <preprocess>
         <config name="TopConfig">""")
-            self.level = 3
-            for config in configs:
-                self.output_config(config)
-            self.level = 0
-            self.addline("""        </config>
+        dax.level = 3
+        if hoist:
+            self.output_hoisted_configs(dax)
+        else:
+            for config in self.iter_configs():
+                self.output_config(dax, config)
+        dax.level = 0
+        dax.addline("""        </config>
     </preprocess>
 </dax>""")
-            pass
-        print("Done writing")
+        dax.flush()
+        changed = write_if_changed(self.output_filename, w.getvalue().encode("utf-8"))
+        if changed:
+            print(f"Done writing {self.output_filename}")
+        else:
+            print(f"{self.output_filename} is unchanged")
+        return changed
 
 
 def usage():
     """ Usage:
-    python3 poly-to-astree.py  output_file  poly_options_file [triple]...
+    python3 poly-to-astree.py [--hoist] output_file  poly_options_file [triple]...
 
     Write Astree configuration dax fragment for a project that has previously
     been configured for Polyspace.
@@ -499,6 +852,7 @@ def usage():
     that contains the compilation options for each file of the project.
 
     output_file is the dax fragment to be inserted into an Astree Dax file.
+    It is only replaced, by an atomic rename, if its content changes.
 
     The triples are strings of the form "old;symbolic;new"
     where
@@ -508,6 +862,12 @@ def usage():
       "new" is a path to the corresponding directory on the current machine
 
     The triples are optional
+
+    With --hoist, includes and defines shared by several configs are written
+    once, in an enclosing shared config, where that makes the output smaller,
+    and each config only lists the ones it does not inherit. Shared includes
+    are only hoisted when they lead the include order of every config sharing
+    them, so the include search order is unchanged.
     """
     print(usage.__doc__)
     sys.exit(1)
@@ -516,6 +876,9 @@ def usage():
 if __name__ == u'__main__':
     print('Using PolySpace Code Prover options to produce Astree configuration\n')
     options = sys.argv[1:]
+    hoist = len(options) > 0 and options[0] == "--hoist"
+    if hoist:
+        options = options[1:]
     if len(options) < 2:
         usage()
     triples = options[2:]
@@ -524,5 +887,5 @@ if __name__ == u'__main__':
             usage()
 
     config = AstreeConfigure(options[0], options[1], triples)
-    config.output_astree_config()
+    config.output_astree_config(hoist)
     print('\ndone.\n')
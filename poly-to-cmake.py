@@ -2,16 +2,27 @@
 This module reads a Polyspace options file (that was generated by watching a build)
 and generated CMakeLists.txt files for each directory in the target repository.
 """
+import hashlib
+import io
 import os
 import re
-from typing import Dict, List, Set, FrozenSet
+import stat
+import sys
+import tempfile
+import threading
+from typing import Dict, List, Set, FrozenSet, Tuple
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from dicttoxml import dicttoxml
 from xml.dom.minidom import parseString
 
 DirectoryName = str
 FileName = str
 
+# The process umask, for the mode of newly written files.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
 
 def get_includes(line: str) -> Set[str]:
     """ Return the set of Include options from the -options-for-sources line. """
@@ -22,116 +33,212 @@ def get_includes(line: str) -> Set[str]:
     return includes
 
 def partition_parts(part_dict: Dict[str, List[str]]) -> List[Set[str]]:
-    part_keys = list(part_dict)
-    num_keys = len(part_keys)
-    assert(num_keys > 0)
-    first_key = part_keys[0]
-    first_list = part_dict[first_key]
-    first_set = set(first_list)
-    partition = [first_set]
-    all_parts = set()
-    for i in range(1, num_keys):
-        for pi in partition:
-            if len(pi) == 0:
-                assert(False)
-        parts = set(part_dict[part_keys[i]])
-        all_parts.update(parts)
-        new_partition = []
-        for pi in partition:
-            if len(parts) == 0:
-                new_partition.append(pi)
-            elif parts.isdisjoint(pi):
-                    new_partition.append(pi)
-            elif parts == pi:
-                new_partition.append(pi)
-                parts = set()
+    """
+    Return the coarsest partition of all the parts such that each list in part_dict
+    is a union of blocks, largest blocks first.
+
+    Each list only refines the blocks its own parts are in, found through a
+    part-to-block map, so the work is linear in the total number of parts.
+    """
+    assert(len(part_dict) > 0)
+    blocks: List[Set[str]] = []
+    block_of: Dict[str, int] = {}
+    # The blocks are kept in a doubly linked chain so that blocks of equal size keep a
+    # stable order: the parts split off a block go just before the rest of it, and new
+    # blocks go last.
+    prev_block: List[int] = []
+    next_block: List[int] = []
+    first = -1
+    last = -1
+    for part_list in part_dict.values():
+        touched: Dict[int, List[str]] = defaultdict(list)
+        new_parts = []
+        for part in set(part_list):
+            block = block_of.get(part)
+            if block is None:
+                new_parts.append(part)
             else:
-                inter = parts.intersection(pi)
-                dif = pi.difference(parts)
-                parts = parts.difference(pi)
-                new_partition.append(inter)
-                if len(dif) > 0:
-                    new_partition.append(dif)
-                pass
-            pass
-        if len(parts) > 0:
-            new_partition.append(parts)
-        partition = new_partition
+                touched[block].append(part)
+        for block, inter in touched.items():
+            if len(inter) == len(blocks[block]):
+                continue
+            split = len(blocks)
+            blocks[block].difference_update(inter)
+            blocks.append(set(inter))
+            for part in inter:
+                block_of[part] = split
+            prev = prev_block[block]
+            prev_block.append(prev)
+            next_block.append(block)
+            prev_block[block] = split
+            if prev < 0:
+                first = split
+            else:
+                next_block[prev] = split
+        if new_parts:
+            block = len(blocks)
+            blocks.append(set(new_parts))
+            for part in new_parts:
+                block_of[part] = block
+            prev_block.append(last)
+            next_block.append(-1)
+            if last < 0:
+                first = block
+            else:
+                next_block[last] = block
+            last = block
         pass
-    pass
+    partition = []
+    block = first
+    while block >= 0:
+        partition.append(blocks[block])
+        block = next_block[block]
     partition = sorted(partition, key=len, reverse=True)
-    partition_all = set();
-    for pi in partition:
-        partition_all.update(pi)
-    assert(all_parts == partition_all)
-    for i in range(len(partition)):
-        for k in range(i+1, len(partition)):
-            assert(partition[i].isdisjoint(partition[k]))
+    # Every part is in exactly one block.
+    assert(sum(len(pi) for pi in partition) == len(block_of))
     return partition
 
-def get_file_partition_indices(part_dict: Dict[FileName, List[str]], partition) -> Dict[FileName, List[int]]:
-    result = {}
-    for file in part_dict:
-        parts = part_dict[file]
-        part_set = set(parts)
-        file_result = []
-        result[file] = file_result
-        for i in range(len(partition)):
-            parti = partition[i]
-            if parti <= part_set:
-                file_result.append(i)
-        pass
-    return result
-
-
-def get_index_groups(file_indices: Dict[FileName, List[int]]) -> Dict[FrozenSet[int], List[FileName]]:
+def get_signature_groups(part_dict: Dict[FileName, List[str]], partition: List[Set[str]]) \
+        -> Tuple[List[FrozenSet[int]], Dict[int, List[FileName]], Dict[FileName, int],
+                 Dict[int, Set[DirectoryName]], Dict[DirectoryName, List[int]]]:
     """
-    The range of file_indices is a list of indices into the partition of options/definitions, etc.
-    Call these option partition groups.
+    Group the files by the set of indices of the partition blocks their parts are in.
+    Call these option partition groups. Every part list is a union of blocks, so the
+    blocks a file's parts are in are the blocks it contains.
 
     Results returned:
 
     group_list - a list of frozen groups, sorted by descending frequency of use.
-
+    group_index_to_files - the files of each group, by index into group_list.
+    file_group - the group index of each file.
+    group_index_to_dirs - the directories of the files of each group.
+    dir_groups - the group indices of each directory, with the directories in file order.
     """
-
-    #
-    group_to_file_list_dict: Dict[FrozenSet[int], List[FileName]] = {}
-    for file in list(file_indices):
-        indices = frozenset(file_indices[file])
-        if indices in group_to_file_list_dict:
-            group_to_file_list_dict[indices].append(file)
-        else:
-            group_to_file_list_dict[indices] = [file]
-    group_list = sorted(list(group_to_file_list_dict), key=lambda fset: len(group_to_file_list_dict[fset]), reverse=True);
-    group_indices = dict([[group_list[i], i] for i in range(len(group_list))])
-    group_index_to_files = dict([[group_indices[fset], group_to_file_list_dict[fset]] for fset in group_list])
-    file_group = dict([[file, group_indices[frozenset(file_indices[file])]] for file in list(file_indices)])
-    group_index_to_dirs = dict([[fset_index, set([os.path.dirname(file) for file in group_index_to_files[fset_index]])] for fset_index in group_index_to_files])
+    block_of: Dict[str, int] = {}
+    for i, pi in enumerate(partition):
+        for part in pi:
+            block_of[part] = i
+    group_to_file_list_dict: Dict[FrozenSet[int], List[FileName]] = defaultdict(list)
+    file_signature: Dict[FileName, FrozenSet[int]] = {}
+    for file, parts in part_dict.items():
+        signature = frozenset([block_of[part] for part in parts])
+        file_signature[file] = signature
+        group_to_file_list_dict[signature].append(file)
+    group_list = sorted(group_to_file_list_dict, key=lambda fset: len(group_to_file_list_dict[fset]), reverse=True)
+    group_indices = {fset: i for i, fset in enumerate(group_list)}
+    group_index_to_files = {i: group_to_file_list_dict[fset] for i, fset in enumerate(group_list)}
+    file_group = {file: group_indices[signature] for file, signature in file_signature.items()}
+    group_index_to_dirs = {i: set([os.path.dirname(file) for file in files]) for i, files in group_index_to_files.items()}
     # Get which group indices a directory is in. We fill in with empty lists so the
     # dictionary will be in alphabetical order (because the files are).
-    dir_groups : Dict[DirectoryName, List[int]] = dict([[os.path.dirname(file), []] for file in list(file_indices)])
-
-    for fset_index in list(group_index_to_dirs):
-        dirs = group_index_to_dirs[fset_index]
+    dir_groups: Dict[DirectoryName, List[int]] = {os.path.dirname(file): [] for file in part_dict}
+    for fset_index, dirs in group_index_to_dirs.items():
         for dir in dirs:
             dir_groups[dir].append(fset_index)
     return (group_list, group_index_to_files, file_group, group_index_to_dirs, dir_groups)
 
+def get_content_hash(filename: FileName) -> bytes:
+    """ Return the digest of the file's content, or b'' if it cannot be read. """
+    try:
+        with open(filename, "rb") as f:
+            return hashlib.blake2b(f.read()).digest()
+    except OSError:
+        return b''
+
+def make_temp_file(filename: FileName) -> Tuple[int, FileName]:
+    """
+    Create a temporary file next to filename, so it can be renamed over it, with the
+    mode of the existing file or, failing that, the default mode for a new file.
+    """
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+                                         prefix='.' + os.path.basename(filename) + '.')
+    try:
+        mode = stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        mode = 0o666 & ~UMASK
+    os.chmod(temp_filename, mode)
+    return fd, temp_filename
+
+def write_if_changed(filename: FileName, content: bytes) -> bool:
+    """
+    Replace filename with content, atomically, unless it already has that content.
+    Return True if the file was written.
+    """
+    if get_content_hash(filename) == hashlib.blake2b(content).digest():
+        return False
+    fd, temp_filename = make_temp_file(filename)
+    try:
+        with os.fdopen(fd, "wb") as w:
+            w.write(content)
+        os.replace(temp_filename, filename)
+    except BaseException:
+        os.unlink(temp_filename)
+        raise
+    return True
+
 def strip_leading(arg: str, leading: str):
     if arg.startswith(leading):
         return "./" + arg[len(leading):]
     else:
         return arg
 
+class PathPrefixNode:
+    """ Node of a PathPrefixMap. """
+    __slots__ = ('children', 'replacement')
+
+    def __init__(self):
+        self.children: Dict[str, 'PathPrefixNode'] = {}
+        # Replacement for the directory prefix ending at this node, if it is one.
+        self.replacement = None
+
+class PathPrefixMap:
+    """
+    Map of directory prefixes, each ending with '/', to their replacements.
+
+    The prefixes are stored in a trie keyed on their path components, so the longest
+    prefix of a path is found in one walk over the path's leading directories,
+    however many prefixes there are.
+    """
+
+    def __init__(self):
+        self.root = PathPrefixNode()
+
+    def add(self, prefix: DirectoryName, replacement: str):
+        assert(prefix.endswith('/'))
+        node = self.root
+        for component in prefix[:-1].split('/'):
+            child = node.children.get(component)
+            if child is None:
+                child = PathPrefixNode()
+                node.children[component] = child
+            node = child
+        node.replacement = replacement
+
+    def replace(self, path: str) -> str:
+        """ Replace the longest prefix of path that is in the map, if any. """
+        node = self.root
+        replacement = None
+        prefix_length = 0
+        start = 0
+        slash = path.find('/')
+        while slash >= 0:
+            node = node.children.get(path[start:slash])
+            if node is None:
+                break
+            start = slash + 1
+            if node.replacement is not None:
+                replacement = node.replacement
+                prefix_length = start
+            slash = path.find('/', start)
+        if replacement is None:
+            return path
+        return replacement + path[prefix_length:]
+
 class CmakeConfigure:
     """ Digest .depend files"""
 
     def adjust_src(self, arg: str):
-        for old in list(self.adjust_dict):
-            if arg.startswith(old):
-                return self.adjust_dict[old] + arg[len(old):]
-        return arg
+        return self.adjust_map.replace(arg)
 
     def strip_inc(self, arg: str):
         if arg.startswith('-I '):
@@ -205,14 +312,14 @@ class CmakeConfigure:
 
     def __init__(self, input_filename: FileName, triples: List[str]):
         self.input_filename = input_filename
-        self.adjust_dict = {}
         self.symbol_dict = {}
+        self.adjust_map = PathPrefixMap()
         for i, triple in enumerate(triples):
             old, symbol, new = triple.split(';')
             old = self.normalize_dir(old)
             new = self.normalize_dir(new)
             symbol_ref = '${' + symbol + "}"
-            self.adjust_dict[old] = symbol_ref + '/'
+            self.adjust_map.add(old, symbol_ref + '/')
             self.symbol_dict[symbol] = new
             if i == 0:
                 self.output_dir = new
@@ -230,9 +337,16 @@ class CmakeConfigure:
         self.vocabulary = self.get_vocabulary()
         self.filter_vocabulary()
         self.partition = partition_parts(self.ofs_dict)
-        self.indices_dict = get_file_partition_indices(self.ofs_dict, self.partition)
         self.group_list, self.group_index_to_files, self.file_group, self.group_index_to_dirs, self.dir_groups = \
-            get_index_groups(self.indices_dict)
+            get_signature_groups(self.ofs_dict, self.partition)
+        # The include, define and option lists of each group, computed when first needed.
+        self.group_lists: Dict[int, Tuple[List[str], List[str], List[str]]] = {}
+        self.group_lists_lock = threading.Lock()
+        # The files of each group in each directory, in file order.
+        self.dir_group_files: Dict[Tuple[DirectoryName, int], List[FileName]] = defaultdict(list)
+        for group, files in self.group_index_to_files.items():
+            for file in files:
+                self.dir_group_files[(os.path.dirname(file), group)].append(file)
 
         # common_includes = get_includes(self.ofs_lines[0])
         # common_usr_includes = get_usr_includes(self.ofs_lines[0])
@@ -308,39 +422,32 @@ class CmakeConfigure:
         return result
 
 
-    def output_includes_for_group(self, libname: str, group: int, w):
+    def get_group_lists(self, group: int) -> Tuple[List[str], List[str], List[str]]:
+        """ Return the include, define and option lists of a group, computing them once per group. """
+        with self.group_lists_lock:
+            if group not in self.group_lists:
+                self.group_lists[group] = self.compute_group_lists(group)
+            return self.group_lists[group]
+
+    def compute_group_lists(self, group: int) -> Tuple[List[str], List[str], List[str]]:
         group_properties: Set[str] = self.get_group_properties(group)
 
         # For includes, the order may be important. Use the order of the
-        # first file for this group.
+        # first file for this group. For defines and options the order is not
+        # important, but use the order of the first file for this group anyway.
         first_file = self.group_index_to_files[group][0]
         file_props: List[str] = self.ofs_dict[first_file]
         include_list = []
+        define_set = set()
+        option_set = set()
         for prop in file_props:
             assert(prop in group_properties)
             if prop.startswith('-I '):
                 include_list.append(prop[3:])
-
-        if len(include_list) > 0:
-            w.write(f"\n# Includes for group {group}\n")
-            w.write(f"target_include_directories({libname} PUBLIC\n")
-            for file in include_list:
-                w.write(f"    {file}\n")
-            w.write(f"    )\n")
-        pass
-
-    def output_defines_for_group(self, libname: str, group: int, w):
-        group_properties: Set[str] = self.get_group_properties(group)
-
-        # For defines, the order is not important, but use the order of the
-        # first file for this group anyway.
-        first_file = self.group_index_to_files[group][0]
-        file_props: List[str] = self.ofs_dict[first_file]
-        define_set = set()
-        for prop in file_props:
-            assert(prop in group_properties)
-            if prop.startswith('-D '):
+            elif prop.startswith('-D '):
                 define_set.add(prop[3:])
+            else:
+                option_set.add(prop)
 
         define_list = list(define_set)
         define_list = sorted(define_list)
@@ -357,6 +464,24 @@ class CmakeConfigure:
                 else:
                     dup_dict[lhs]=parts[1]
 
+        option_list = list(option_set)
+        option_list = sorted(option_list)
+        return include_list, define_list, option_list
+
+    def output_includes_for_group(self, libname: str, group: int, w):
+        include_list = self.get_group_lists(group)[0]
+
+        if len(include_list) > 0:
+            w.write(f"\n# Includes for group {group}\n")
+            w.write(f"target_include_directories({libname} PUBLIC\n")
+            for file in include_list:
+                w.write(f"    {file}\n")
+            w.write(f"    )\n")
+        pass
+
+    def output_defines_for_group(self, libname: str, group: int, w):
+        define_list = self.get_group_lists(group)[1]
+
         if len(define_list) > 0:
             w.write(f"\n# Defines for group {group}\n")
             w.write(f"target_compile_definitions({libname} PUBLIC\n")
@@ -366,20 +491,7 @@ class CmakeConfigure:
         pass
 
     def output_options_for_group(self, libname: str, group: int, w):
-        group_properties: Set[str] = self.get_group_properties(group)
-
-        # For options, the order is not important, but use the order of the
-        # first file for this group anyway.
-        first_file = self.group_index_to_files[group][0]
-        file_props: List[str] = self.ofs_dict[first_file]
-        option_set = set()
-        for prop in file_props:
-            assert(prop in group_properties)
-            if not prop.startswith('-D ') and not prop.startswith('-I '):
-                option_set.add(prop)
-
-        option_list = list(option_set)
-        option_list = sorted(option_list)
+        option_list = self.get_group_lists(group)[2]
 
         if len(option_list) > 0:
             w.write(f"\n# Options for group {group}\n")
@@ -392,7 +504,7 @@ class CmakeConfigure:
     def output_group_for_dir(self, level: int, the_dir: DirectoryName, group: int, w):
         w.write(f"# Specification for group {group} for directory {the_dir}\n")
         # Use the first source file for the name of the library.
-        group_dir_file_list = [file for file in self.group_index_to_files[group] if os.path.dirname(file) == the_dir]
+        group_dir_file_list = self.dir_group_files[(the_dir, group)]
 
         assert(len(group_dir_file_list) > 0)
         if len(self.dir_groups[the_dir]) > 1 or level == 1:
@@ -419,13 +531,21 @@ class CmakeConfigure:
         w.write("\n")
         pass
 
-    def output_single_cmake_file(self, level: int, the_dir: DirectoryName):
+    def output_single_cmake_file(self, level: int, the_dir: DirectoryName) -> bool:
+        """ Write the CMakeLists.txt for the_dir unless it already has that content. Return True if written. """
         print(f"Processing dir={the_dir}")
         relative_dir = the_dir[len(self.adjusted_target_dir):]
         actual_target_dir = self.output_dir + relative_dir
         os.makedirs(actual_target_dir, exist_ok=True)
         cmake_file = os.path.join(actual_target_dir, "CMakeLists.txt")
-        with open(cmake_file, "w") as w:
+        # Leave an unchanged file alone so its mtime does not trigger a CMake reconfigure.
+        changed = write_if_changed(cmake_file, self.render_cmake_file(level, the_dir).encode())
+
+        print(f"Done processing dir={the_dir}")
+        return changed
+
+    def render_cmake_file(self, level: int, the_dir: DirectoryName) -> str:
+        with io.StringIO() as w:
             if level == 1:
                 # Output special stuff for top level.
                 w.write(
@@ -452,21 +572,33 @@ set(CMAKE_CXX_COMPILER clang++-9)
             if the_dir in self.dir_groups:
                 for group in self.dir_groups[the_dir]:
                     self.output_group_for_dir(level, the_dir, group, w)
+            return w.getvalue()
+
+    def get_tree_dirs(self, level: int, root: DirectoryName) -> List[Tuple[int, DirectoryName]]:
+        """ Return the (level, directory) pairs of the tree under root, parents before children. """
+        result = []
+        stack = [(level, root)]
+        while stack:
+            level, the_dir = stack.pop()
+            result.append((level, the_dir))
+            if the_dir in self.children_dict:
+                for child in reversed(self.children_dict[the_dir]):
+                    stack.append((level + 1, child))
+        return result
 
-        print(f"Done processing dir={the_dir}")
-
-        pass
-
-    def output_cmake_tree(self, level: int, root: DirectoryName):
-        self.output_single_cmake_file(level, root)
-        if root in self.children_dict:
-            for child in self.children_dict[root]:
-                self.output_cmake_tree(level + 1, child)
-        pass
+    def output_cmake_tree(self, level: int, root: DirectoryName, max_workers: int = None) -> List[DirectoryName]:
+        """ Write the CMakeLists.txt files of the tree under root and return the directories whose file changed. """
+        tree_dirs = self.get_tree_dirs(level, root)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            written = list(executor.map(lambda level_dir: self.output_single_cmake_file(*level_dir), tree_dirs))
+        changed_dirs = [os.path.normpath(self.output_dir + the_dir[len(self.adjusted_target_dir):])
+                        for (level, the_dir), changed in zip(tree_dirs, written) if changed]
+        print(f"Wrote {len(changed_dirs)} of {len(tree_dirs)} CMakeLists.txt files")
+        return changed_dirs
 
 def usage():
     """ Usage:
-    python3 poly-to-cmake.py poly_options_file triple [triple]...
+    python3 poly-to-cmake.py [--changed-list list_file] poly_options_file triple [triple]...
 
     Write CMakeLists.txt files for a project that has previously
     been configured for Polyspace.
@@ -483,6 +615,10 @@ def usage():
 
     The first triple must be present and represents the source/target tree.
     Subsequent triples can represent other directories referenced by the build.
+
+    Only the CMakeLists.txt files whose content changes are rewritten, each by
+    an atomic rename. The directories whose CMakeLists.txt changed are printed
+    and, with --changed-list, written one per line to list_file.
     """
     print(usage.__doc__)
     sys.exit(1)
@@ -490,6 +626,12 @@ def usage():
 if __name__ == u'__main__':
     print('Using PolySpace Code Prover options to produce cmake configuration\n')
     options = sys.argv[1:]
+    changed_list_filename = None
+    if len(options) > 0 and options[0] == "--changed-list":
+        if len(options) < 2:
+            usage()
+        changed_list_filename = options[1]
+        options = options[2:]
     if len(options) < 2:
         usage()
     triples = options[1:]
@@ -499,5 +641,11 @@ if __name__ == u'__main__':
 
     cmconfig = CmakeConfigure(options[0], triples)
     cmconfig.find_children_dirs()
-    cmconfig.output_cmake_tree(1, cmconfig.adjusted_target_dir)
+    changed_dirs = cmconfig.output_cmake_tree(1, cmconfig.adjusted_target_dir)
+    for changed_dir in changed_dirs:
+        print(f"Changed: {changed_dir}")
+    if changed_list_filename is not None:
+        with open(changed_list_filename, "w") as w:
+            for changed_dir in changed_dirs:
+                w.write(changed_dir + "\n")
     print('\ndone.\n')